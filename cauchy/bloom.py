@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+from typing import Iterator
+
+# capacity, size in bits and hash count of a serialized filter, followed by its bits
+_HEADER = struct.Struct(">QQB")
+
+
+def key_hashes(key: bytes) -> tuple[int, int]:
+    """
+    Returns the two hashes of an encoded key the bit positions of every filter are derived from,
+    the two halves of a single 128-bit digest. They do not depend on the filter, so a key probed
+    against many filters is hashed once.
+    """
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class BloomFilter:
+    """
+    A Bloom filter to test whether a key might be part of a data segment.
+    False positives are possible, false negatives are not.
+
+    Args:
+        capacity (int): The number of keys the filter is sized for.
+        bits_per_key (int): The number of bits allocated per key.
+        hash_count (int): The number of bit positions set per key.
+    """
+
+    def __init__(self, capacity: int, bits_per_key: int = 10, hash_count: int = 7):
+        self.capacity = capacity
+        self._size = max(capacity * bits_per_key, 64)
+        self._hash_count = hash_count
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def add(self, key: bytes):
+        for position in self._positions(key_hashes(key)):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.might_contain(key_hashes(key))
+
+    def might_contain(self, hashes: tuple[int, int]) -> bool:
+        """
+        Tests a key by the hashes returned by key_hashes, stopping at the first unset bit.
+        """
+        bits = self._bits
+        for position in self._positions(hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def size_in_bytes(self) -> int:
+        return len(self._bits)
+
+    def to_bytes(self) -> bytes:
+        return _HEADER.pack(self.capacity, self._size, self._hash_count) + self._bits
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> BloomFilter:
+        """
+        Restores a filter serialized by to_bytes. Raises ValueError if data is truncated.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("truncated bloom filter")
+        capacity, size, hash_count = _HEADER.unpack_from(data)
+        bits = bytearray(data[_HEADER.size :])
+        if len(bits) != (size + 7) // 8:
+            raise ValueError("truncated bloom filter")
+        bloom = cls(0, hash_count=hash_count)
+        bloom.capacity = capacity
+        bloom._size = size
+        bloom._bits = bits
+        return bloom
+
+    def _positions(self, hashes: tuple[int, int]) -> Iterator[int]:
+        """
+        Derives the bit positions for the hashes of a key with double hashing, h1 + i * h2.
+        """
+        h1, h2 = hashes
+        size = self._size
+        for i in range(self._hash_count):
+            yield (h1 + i * h2) % size
+
+
+class BloomFilterCache:
+    """
+    A least recently used cache of bloom filters persisted to files, keyed by their paths
+    and bounded by the total size of their bits rather than by their number.
+
+    Args:
+        max_bytes (int): The maximum total size in bytes of the bits of the cached filters.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._filters: OrderedDict[str, BloomFilter] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size_in_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, path: str) -> BloomFilter | None:
+        """
+        Returns the filter of a path, read from its file and cached if it is not cached,
+        or None if the file is missing or truncated.
+        """
+        with self._lock:
+            bloom = self._filters.get(path)
+            if bloom is not None:
+                self._filters.move_to_end(path)
+                return bloom
+        try:
+            with open(path, "rb") as f:
+                bloom = BloomFilter.from_bytes(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        self.put(path, bloom)
+        return bloom
+
+    def put(self, path: str, bloom: BloomFilter):
+        """
+        Caches the filter of a path as the most recently used one,
+        evicting the least recently used filters until the cache is within its size.
+        """
+        with self._lock:
+            previous = self._filters.pop(path, None)
+            if previous is not None:
+                self._bytes -= previous.size_in_bytes
+            self._filters[path] = bloom
+            self._bytes += bloom.size_in_bytes
+            while self._bytes > self._max_bytes:
+                _, evicted = self._filters.popitem(last=False)
+                self._bytes -= evicted.size_in_bytes
+
+    def discard(self, path: str):
+        with self._lock:
+            bloom = self._filters.pop(path, None)
+            if bloom is not None:
+                self._bytes -= bloom.size_in_bytes
+
+
+class CachedBloomFilter:
+    """
+    A bloom filter persisted to a file and loaded through a BloomFilterCache when it is probed,
+    in place of a BloomFilter kept in memory. A filter whose file is gone rules out no key.
+    """
+
+    def __init__(self, path: str, capacity: int, cache: BloomFilterCache):
+        self.path = path
+        self.capacity = capacity
+        self._cache = cache
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.might_contain(key_hashes(key))
+
+    def might_contain(self, hashes: tuple[int, int]) -> bool:
+        bloom = self._cache.get(self.path)
+        return bloom is None or bloom.might_contain(hashes)
@@ -1,5 +1,7 @@
 import socket
 
+from .protocol import encode_message, recv_message
+
 
 class Client:
     """
@@ -16,6 +18,8 @@ class Client:
         The exit command closes the connection.
         """
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # disable Nagle's algorithm, requests are small and latency bound
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         try:
             client_socket.connect((self.host, self.port))
             print("Connected to server ", self.host, ":", self.port)
@@ -28,11 +32,11 @@ class Client:
                 if message.lower() == "exit":
                     break
 
-                # Send the message to the server
-                client_socket.sendall(message.encode())
+                # Send the message to the server, prefixed by its length
+                client_socket.sendall(encode_message(message.encode()))
 
-                # Get the server's response
-                print(client_socket.recv(1024).decode())
+                # Get the server's response, also prefixed by its length
+                print(recv_message(client_socket).decode())
 
             client_socket.close()
             print("Connection closed")
@@ -1,15 +1,358 @@
 from __future__ import annotations
 
+import array
 import bisect
+import contextlib
+import glob
+import heapq
+import io
+import mmap
+import multiprocessing
 import os
 import struct
+import sys
 import threading
-from typing import BinaryIO, Union
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, NamedTuple, cast
 
-from pympler import asizeof
-from sortedcontainers import SortedDict
+from .bloom import BloomFilter, BloomFilterCache, CachedBloomFilter, key_hashes
+from .records import (
+    TOMBSTONE,
+    Tombstone,
+    U,
+    pack_record,
+    pack_record_into,
+    read_raw_record,
+    read_record,
+)
 
-U = Union[int, float, str]
+# fdatasync skips syncing file metadata, it is not available on every platform
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+# directories can only be opened, and synced, where O_DIRECTORY is available
+_O_DIRECTORY: int | None = getattr(os, "O_DIRECTORY", None)
+# madvise and its advice values are not available on every platform
+_MADV_WILLNEED: int | None = getattr(mmap, "MADV_WILLNEED", None)
+_MADV_RANDOM: int | None = getattr(mmap, "MADV_RANDOM", None)
+_MADV_SEQUENTIAL: int | None = getattr(mmap, "MADV_SEQUENTIAL", None)
+# string values up to this length are deduplicated in the memtable, up to this many distinct values
+_MAX_INTERNED_VALUE_LENGTH = 64
+_MAX_INTERNED_VALUES = 4096
+# marks a key that is not in a memtable, falsy values such as 0 or "" are valid values
+_MISSING: Any = object()
+
+
+class Segment(NamedTuple):
+    """
+    A data segment on disk, its sparse index as a sorted list of the first encoded key of each block
+    and a parallel array of unsigned 64-bit block start offsets, its last encoded key, the bloom filter of its keys,
+    a read only memory map of the segment file and its size in bytes.
+    Blocks are contiguous, a block ends where the next one starts or at the end of the segment.
+    The keys of the segment range from the first block key to max_key.
+    With a bloom filter cache, the bloom filter of a segment on disk is loaded from its file when it is probed.
+    shard is the memtable shard the segment was flushed from, or None if it may hold keys of any shard.
+    A segment that was just flushed is held in memory, data is then the serialized segment,
+    until it is written to its file.
+    """
+
+    name: str
+    block_keys: list[bytes]
+    block_starts: array.array[int]
+    max_key: bytes
+    bloom: BloomFilter | CachedBloomFilter
+    data: mmap.mmap | bytes
+    size: int
+    shard: int | None = None
+
+    @property
+    def in_memory(self) -> bool:
+        return not isinstance(self.data, mmap.mmap)
+
+
+class SegmentRanges(NamedTuple):
+    """
+    The data segments, oldest first, with the first and last encoded key of every segment
+    in lists parallel to them, so a get skips the segments whose key range does not hold a key
+    by comparing plain list items, without going through the segments.
+    """
+
+    segments: list[Segment]
+    first_keys: list[bytes]
+    max_keys: list[bytes]
+
+
+class SegmentFile(NamedTuple):
+    """
+    A data segment file written to disk, with the sparse index, last key and bloom filter of a Segment,
+    before it is memory mapped. It can be sent between processes, unlike a Segment.
+    """
+
+    name: str
+    block_keys: list[bytes]
+    block_starts: array.array[int]
+    max_key: bytes
+    bloom: BloomFilter
+    size: int
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _BlockCache:
+    """
+    A least recently used cache of parsed blocks, keyed by the memory map of their segment and their offsets,
+    with the interface of a functools.lru_cache of load. Unlike an lru_cache, it tells whether a block is cached
+    without loading it, so a batch only prefetches the blocks it reads from the disk.
+    """
+
+    def __init__(
+        self,
+        load: Callable[
+            [mmap.mmap | bytes, int, int], dict[bytes, tuple[U | Tombstone, bool, int]]
+        ],
+        maxsize: int,
+    ):
+        self._load = load
+        self._maxsize = maxsize
+        self._blocks: OrderedDict[
+            tuple[mmap.mmap | bytes, int, int],
+            dict[bytes, tuple[U | Tombstone, bool, int]],
+        ] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: tuple[mmap.mmap | bytes, int, int]) -> bool:
+        return key in self._blocks
+
+    def __call__(
+        self, data: mmap.mmap | bytes, block_start: int, block_end: int
+    ) -> dict[bytes, tuple[U | Tombstone, bool, int]]:
+        key = (data, block_start, block_end)
+        # a hit does not take the lock, single OrderedDict operations are atomic
+        block = self._blocks.get(key)
+        if block is not None:
+            try:
+                self._blocks.move_to_end(key)
+            except KeyError:
+                # evicted by a concurrent load
+                pass
+            self._hits += 1
+            return block
+        self._misses += 1
+        # the block is parsed outside the lock, concurrent gets of other blocks are not serialized
+        block = self._load(data, block_start, block_end)
+        with self._lock:
+            if self._maxsize > 0:
+                self._blocks[key] = block
+                if len(self._blocks) > self._maxsize:
+                    self._blocks.popitem(last=False)
+        return block
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._blocks))
+
+    def cache_clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+def _advise(data: mmap.mmap | bytes, advice: int | None):
+    """
+    Advises the kernel of how a memory map will be read, one of the madvise constants, or does nothing
+    if the advice is not available or data is in memory. Random reads disable readahead, so a point lookup only reads its block,
+    sequential reads read ahead aggressively and drop the pages behind.
+    """
+    if advice is not None and isinstance(data, mmap.mmap):
+        data.madvise(advice)
+
+
+def _map_file(path: str, advice: int | None) -> mmap.mmap:
+    """
+    Memory maps a file read only, advised for how it will be read, see _advise.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _advise(data, advice)
+    return data
+
+
+@contextlib.contextmanager
+def _synced_file(path: str, buffering: int = -1) -> Iterator[BinaryIO]:
+    """
+    Opens a file to write it and syncs its data to disk once it is written.
+    """
+    with open(path, "wb", buffering=buffering) as f:
+        yield f
+        f.flush()
+        # the file size is synced with the data, the other metadata is not needed to read it back
+        _fdatasync(f.fileno())
+
+
+def _bloom_path(data_segment_name: str) -> str:
+    return data_segment_name + ".bf"
+
+
+def _write_bloom(data_segment_name: str, bloom: BloomFilter):
+    with _synced_file(_bloom_path(data_segment_name)) as f:
+        f.write(bloom.to_bytes())
+
+
+def _pack_data_segment(
+    f: BinaryIO,
+    items: Iterable[tuple[bytes, U | Tombstone]],
+    expected_item_count: int,
+    block_size: int,
+) -> tuple[list[bytes], array.array[int], bytes, BloomFilter, int]:
+    """
+    Writes items, sorted by encoded key, to f in blocks of block_size bytes and returns the sparse index,
+    the last key, a bloom filter of the keys sized for expected_item_count and the number of bytes written.
+    Records are packed into a block buffer allocated once, which is written with a single call
+    per block, so block offsets are tracked from the bytes written instead of calling f.tell().
+    """
+    block_keys: list[bytes] = []
+    block_starts = array.array("Q")
+    bloom = BloomFilter(expected_item_count)
+    block = bytearray(block_size)
+    max_key = b""
+    used = 0
+    written = 0
+    for encoded_key, value in items:
+        bloom.add(encoded_key)
+        max_key = encoded_key
+        record_end = pack_record_into(block, used, encoded_key, value)
+
+        if not block_keys:
+            # the first key always starts the first block
+            block_keys.append(encoded_key)
+            block_starts.append(0)
+        elif record_end > block_size and used:
+            # if the current block size + the size of the new key value pair is greater than the block size,
+            # then the current block is written and the record starts a new block
+            with memoryview(block) as view:
+                written += f.write(view[:used])
+            block[: record_end - used] = block[used:record_end]
+            record_end -= used
+            block_keys.append(encoded_key)
+            block_starts.append(written)
+        used = record_end
+    if block_keys:
+        with memoryview(block) as view:
+            written += f.write(view[:used])
+    # blocks were started in key order, so the block keys are already sorted
+    return block_keys, block_starts, max_key, bloom, written
+
+
+def _write_data_segment_file(
+    data_segment_name: str,
+    items: Iterable[tuple[bytes, U | Tombstone]],
+    expected_item_count: int,
+    block_size: int,
+) -> SegmentFile | None:
+    """
+    Writes items, sorted by encoded key, to a data segment file, see _pack_data_segment, through a large
+    write buffer and returns it. The bloom filter is persisted next to the segment.
+    If there are no items, no segment is written and None is returned.
+    """
+    with _synced_file(data_segment_name, buffering=1 << 20) as f:
+        block_keys, block_starts, max_key, bloom, written = _pack_data_segment(
+            f, items, expected_item_count, block_size
+        )
+
+    if not written:
+        os.remove(data_segment_name)
+        return None
+    _write_bloom(data_segment_name, bloom)
+    return SegmentFile(
+        data_segment_name, block_keys, block_starts, max_key, bloom, written
+    )
+
+
+def _latest_live_items(
+    merged_items: Iterable[tuple[bytes, int, U | Tombstone]],
+) -> Iterator[tuple[bytes, U]]:
+    """
+    Keeps only the first item of each run of duplicate keys, dropping it if it is tombstoned.
+    """
+    previous_key = None
+    for key, _, value in merged_items:
+        if key == previous_key:
+            continue
+        previous_key = key
+        if value is not TOMBSTONE:
+            yield key, value
+
+
+def _iter_records_in_range(
+    data,
+    block_keys: list[bytes],
+    block_starts: array.array[int],
+    low: bytes | None,
+    high: bytes | None,
+    rank: int,
+) -> Iterator[tuple[bytes, int, U | Tombstone]]:
+    """
+    Yields the encoded key, rank and value of every item of a segment with a key from low, included,
+    to high, excluded, in key order. A bound of None leaves that side of the range open.
+    Reading starts at the block that may hold low, found in the sparse index.
+    See LSMTree._iter_segment for the rank.
+    """
+    offset = 0
+    if low is not None:
+        index = bisect.bisect_right(block_keys, low) - 1
+        if index > 0:
+            offset = block_starts[index]
+    size = len(data)
+    while offset < size:
+        key, value, _, offset = read_raw_record(data, offset)
+        if low is not None and key < low:
+            continue
+        if high is not None and key >= high:
+            return
+        yield key, rank, value
+
+
+def _merge_segment_range(
+    merged_data_segment_name: str,
+    segments: list[tuple[str, list[bytes], array.array[int]]],
+    low: bytes | None,
+    high: bytes | None,
+    expected_item_count: int,
+    block_size: int,
+) -> SegmentFile | None:
+    """
+    Merges the items of segments, newest first, given by name and sparse index, with a key from low to high
+    into a new data segment, like _merge_and_compact does for the whole key range.
+    Runs in a compaction process, so it only takes and returns values that can be sent between processes,
+    and maps the segments itself.
+    """
+    maps = []
+    try:
+        ranges = []
+        for rank, (name, block_keys, block_starts) in enumerate(segments):
+            data = _map_file(name, _MADV_SEQUENTIAL)
+            maps.append(data)
+            ranges.append(
+                _iter_records_in_range(data, block_keys, block_starts, low, high, rank)
+            )
+        merged_items = heapq.merge(*ranges)
+        return _write_data_segment_file(
+            merged_data_segment_name,
+            _latest_live_items(merged_items),
+            expected_item_count,
+            block_size,
+        )
+    finally:
+        for data in maps:
+            data.close()
 
 
 class LSMTree:
@@ -19,6 +362,23 @@ class LSMTree:
     Args:
         memtable_max_size (int): The maximum size of the memtable in megabytes.
         sstable_block_size (int): The size of each block in the SSTable in kilobytes.
+        block_cache_size (int): The maximum number of parsed SSTable blocks kept in memory.
+        merge_interval (float): The number of seconds between two compactions of the data segments.
+        compaction_threshold (int): The number of data segments above which a memtable flush
+            triggered by put wakes the background compaction up before merge_interval elapses.
+        memtable_shards (int): The number of hash partitions of the memtable, at least 1.
+            Each shard is flushed to its own data segment, in parallel.
+            A full memtable is flushed in the background, put only waits for a previous flush.
+        wal_sync_batch (int): The number of writes to the write-ahead log after which it is synced to disk.
+        wal_sync_interval (float): The maximum time in seconds a write to the write-ahead log stays unsynced.
+        read_threads (int): The number of threads a get searches the data segments that may hold the key with,
+            in parallel. 0, the default, searches them one at a time, newest first.
+        compaction_processes (int): The number of processes a compaction merges disjoint key ranges of
+            the data segments in, in parallel, into one segment per range. 0, the default, merges all the segments
+            into a single segment in the compaction thread.
+        bloom_cache_size (int | None): The maximum size in kilobytes of the bloom filters of the data segments
+            kept in memory, the least recently probed filters are read from their files again when they are probed.
+            None, the default, keeps the filters of all the segments in memory.
     """
 
     def __init__(
@@ -27,283 +387,1060 @@ class LSMTree:
         memtable_max_size: int = 64,
         sstable_block_size: int = 4,
         merge_interval: float = 3600,
+        block_cache_size: int = 1024,
+        compaction_threshold: int = 8,
+        memtable_shards: int = 1,
+        wal_sync_batch: int = 128,
+        wal_sync_interval: float = 0.005,
+        read_threads: int = 0,
+        compaction_processes: int = 0,
+        bloom_cache_size: int | None = None,
     ):
-        self._memtable: dict[str, U] = SortedDict()
-        self._memtable_being_flushed: dict[str, U] = SortedDict()
+        if memtable_shards < 1:
+            raise ValueError("memtable_shards must be at least 1")
+        if read_threads < 0:
+            raise ValueError("read_threads must not be negative")
+        if compaction_processes < 0:
+            raise ValueError("compaction_processes must not be negative")
+        self._storage_location = storage_location
+        self._memtable_shards = memtable_shards
+        self._memtables: list[dict[str, U | Tombstone]] = [
+            {} for _ in range(memtable_shards)
+        ]
+        self._memtables_being_flushed: list[dict[str, U | Tombstone]] = [
+            {} for _ in range(memtable_shards)
+        ]
         self._memtable_max_size = memtable_max_size * 1024 * 1024
+        self._memtable_bytes = 0
+        # the short string values of the memtable by themselves, replaced with the memtable
+        self._memtable_values: dict[str, str] = {}
         self._sstable_block_size = sstable_block_size * 1024
         self._merge_interval = merge_interval
-        self._data_segments: list[tuple[str, dict]] = []
+        self._segment_ranges = SegmentRanges([], [], [])
         self._last_sstable_id = 0
         self._last_merged_sstable_id = 0
+        self._compaction_threshold = compaction_threshold
+        # guards replacing and appending to the list of data segments
+        self._segments_lock = threading.Lock()
+        # incremented every time a compaction replaces the list of data segments
+        self._segments_generation = 0
+        # only one compaction runs at a time
+        self._compaction_lock = threading.Lock()
+        self._compaction_processes = compaction_processes
+        # started by the first compaction that uses it
+        self._compaction_pool: ProcessPoolExecutor | None = None
+        # wakes the merge scheduler up when a flush leaves too many data segments or the tree is closed
+        self._merge_condition = threading.Condition()
+        self._merge_requested = False
+        self._merge_stopped = False
+        self._flush_executor = ThreadPoolExecutor(max_workers=memtable_shards)
+        # flushes started by put are written by a background thread, one at a time
+        self._flush_lock = threading.Lock()
+        self._background_flusher = ThreadPoolExecutor(max_workers=1)
+        self._pending_flush: Future | None = None
+        self._read_pool = (
+            ThreadPoolExecutor(max_workers=read_threads) if read_threads else None
+        )
+        self._load_block = _BlockCache(self._read_block, block_cache_size)
+        self._bloom_cache = (
+            BloomFilterCache(bloom_cache_size * 1024)
+            if bloom_cache_size is not None
+            else None
+        )
         if not os.path.exists(storage_location):
             os.mkdir(storage_location)
+        # the segments of a previous run are loaded first, so new segments do not reuse their names
+        self._load_data_segments()
+
+        # every memtable generation is logged to its own write-ahead log file,
+        # which is deleted once the memtable is flushed
+        self._wal_sync_batch = wal_sync_batch
+        self._wal_sync_interval = wal_sync_interval
+        self._wal_lock = threading.Lock()
+        self._wal_unsynced = threading.Event()
+        self._wal_pending = 0
+        self._wal_closed = False
+        self._wal_paths = sorted(
+            glob.glob(os.path.join(storage_location, "wal_*.log")),
+            key=self._wal_id_from_path,
+        )
+        self._replay_wal()
+        self._wal_id = (
+            self._wal_id_from_path(self._wal_paths[-1]) + 1 if self._wal_paths else 1
+        )
+        self._wal_fd = self._open_wal()
+        self._wal_syncer = threading.Thread(target=self._run_wal_syncer, daemon=True)
+        self._wal_syncer.start()
 
-        # call _merge_and_compact() every hour in a separate thread
-        self._merge_scheduler: threading.Timer = threading.Timer(
-            self._merge_interval, self._merge_and_compact
+        # call _merge_and_compact() every merge_interval seconds, or when requested by a flush, in a separate thread
+        self._merge_scheduler = threading.Thread(
+            target=self._run_merge_scheduler, daemon=True
         )
         self._merge_scheduler.start()
 
-    def get(self, key: str) -> U | None:
-        memtable_result = self._memtable.get(key) or self._memtable_being_flushed.get(
-            key
+    @property
+    def _data_segments(self) -> list[Segment]:
+        return self._segment_ranges.segments
+
+    @_data_segments.setter
+    def _data_segments(self, segments: list[Segment]):
+        """
+        Replaces the data segments and their key ranges with a single assignment, so readers always
+        see lists that match. The list of segments is never mutated once it is set.
+        """
+        self._segment_ranges = SegmentRanges(
+            segments,
+            [segment.block_keys[0] for segment in segments],
+            [segment.max_key for segment in segments],
         )
-        if memtable_result == "tombstone":
+
+    def get(self, key: str) -> U | None:
+        shard = self._shard_for(key)
+        memtable_result = self._memtables[shard].get(key, _MISSING)
+        if memtable_result is _MISSING:
+            memtable_result = self._memtables_being_flushed[shard].get(key, _MISSING)
+        if memtable_result is TOMBSTONE:
             return None
-        elif memtable_result is not None:
+        elif memtable_result is not _MISSING:
             return memtable_result
         else:
-            for segment in reversed(self._data_segments):
-                segment_result = self._find_item_in_segment(key, segment)
-                if segment_result is not None:
-                    return segment_result[0]
+            encoded_key = key.encode("utf-8")
+            # the key is hashed once for the bloom filters of all segments
+            hashes = key_hashes(encoded_key)
+            # compaction replaces the list instead of mutating it, so iterate over the current one,
+            # the generation is read first so it is never newer than the list
+            generation = self._segments_generation
+            segments, first_keys, max_keys = self._segment_ranges
+            if self._read_pool is not None:
+                return self._find_in_segments_in_parallel(
+                    self._read_pool, encoded_key, hashes, shard, segments, generation
+                )
+            for index in range(len(segments) - 1, -1, -1):
+                if not first_keys[index] <= encoded_key <= max_keys[index]:
+                    # the key is outside the key range of the segment
+                    continue
+                segment = segments[index]
+                if segment.shard not in (None, shard) or not (
+                    segment.bloom.might_contain(hashes)
+                ):
+                    # the key is definitely not in this segment, skip the disk read
+                    continue
+                item = self._find_record_in_segment(encoded_key, segment, generation)
+                if item is not None:
+                    value = item[0]
+                    # a tombstone is the latest write of the key, older segments are not searched
+                    return None if value is TOMBSTONE else value
+        return None
+
+    def get_batch(self, keys: list[str]) -> list[U | None]:
+        """
+        Gets the values of many keys at once, in the order of keys, None for a key that is not found.
+        The keys that are not in a memtable are looked up segment by segment, newest first, in encoded key order,
+        so the keys a segment holds in the same block share a single load of the block.
+        The blocks of a segment that may hold the keys are all requested from the disk before the first is parsed,
+        so their reads overlap.
+        """
+        results: list[U | None] = [None] * len(keys)
+        # the shard, bloom filter hashes and positions in keys of every encoded key still to be found in the segments
+        pending: dict[bytes, tuple[int, tuple[int, int], list[int]]] = {}
+        for position, key in enumerate(keys):
+            shard = self._shard_for(key)
+            value = self._memtables[shard].get(key, _MISSING)
+            if value is _MISSING:
+                value = self._memtables_being_flushed[shard].get(key, _MISSING)
+            if value is _MISSING:
+                encoded_key = key.encode("utf-8")
+                if encoded_key not in pending:
+                    pending[encoded_key] = (shard, key_hashes(encoded_key), [])
+                pending[encoded_key][2].append(position)
+            elif value is not TOMBSTONE:
+                results[position] = value
+
+        # the generation is read first so it is never newer than the list, see get
+        generation = self._segments_generation
+        segments = self._data_segments
+        remaining = sorted(pending)
+        for segment in reversed(segments):
+            if not remaining:
+                break
+            candidates = (
+                encoded_key
+                for encoded_key in remaining
+                if self._segment_may_hold(
+                    segment,
+                    encoded_key,
+                    pending[encoded_key][1],
+                    pending[encoded_key][0],
+                )
+            )
+            # keys are sorted, so the keys of a block are consecutive
+            keys_by_block: dict[tuple[int, int], list[bytes]] = {}
+            for encoded_key, block_range in self._find_blocks_for_keys(
+                candidates, segment
+            ):
+                keys_by_block.setdefault(block_range, []).append(encoded_key)
+            self._prefetch_blocks(segment, keys_by_block)
+
+            found = set()
+            for block_range, block_keys in keys_by_block.items():
+                block = self._load_segment_block(segment, block_range, generation)
+                for encoded_key in block_keys:
+                    item = block.get(encoded_key)
+                    if item is None:
+                        continue
+                    # a tombstone is the latest write of the key, older segments are not searched
+                    if item[0] is not TOMBSTONE:
+                        for position in pending[encoded_key][2]:
+                            results[position] = item[0]
+                    found.add(encoded_key)
+            if found:
+                remaining = [key for key in remaining if key not in found]
+        return results
+
+    def _prefetch_blocks(
+        self, segment: Segment, block_ranges: Iterable[tuple[int, int]]
+    ):
+        """
+        Advises the kernel that the blocks of the segment between their start and end offsets, in order,
+        will be read soon, so it starts reading the pages of all of them from the disk at once.
+        Blocks in the block cache are not read from the segment and are skipped, adjacent blocks are advised
+        as a single range. Does nothing if madvise is not available or the segment is in memory.
+        """
+        data = segment.data
+        if _MADV_WILLNEED is None or not isinstance(data, mmap.mmap):
+            return
+        for range_start, range_end in self._uncached_ranges(data, block_ranges):
+            # madvise takes a page aligned start
+            page_start = range_start - range_start % mmap.PAGESIZE
+            data.madvise(_MADV_WILLNEED, page_start, range_end - page_start)
+
+    def _uncached_ranges(
+        self, data: mmap.mmap, block_ranges: Iterable[tuple[int, int]]
+    ) -> list[tuple[int, int]]:
+        """
+        Returns the byte ranges of the blocks of a segment, in order, that are not in the block cache,
+        adjacent blocks merged into a single range.
+        """
+        ranges: list[tuple[int, int]] = []
+        for block_start, block_end in block_ranges:
+            if (data, block_start, block_end) in self._load_block:
+                continue
+            if ranges and ranges[-1][1] == block_start:
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((block_start, block_end))
+        return ranges
+
+    def _segment_may_hold(
+        self,
+        segment: Segment,
+        encoded_key: bytes,
+        hashes: tuple[int, int],
+        shard: int,
+    ) -> bool:
+        """
+        Returns whether the segment may hold the key, from in-memory checks only: the segment holds keys
+        of the shard of the key, the key is within the key range of the segment
+        and the bloom filter of the segment, probed with the hashes of the key, does not rule it out.
+        """
+        return (
+            segment.shard in (None, shard)
+            and segment.block_keys[0] <= encoded_key <= segment.max_key
+            and segment.bloom.might_contain(hashes)
+        )
+
+    def _find_in_segments_in_parallel(
+        self,
+        read_pool: ThreadPoolExecutor,
+        encoded_key: bytes,
+        hashes: tuple[int, int],
+        shard: int,
+        segments: list[Segment],
+        generation: int,
+    ) -> U | None:
+        """
+        Searches every segment that may hold the key in parallel on the read pool
+        and returns the value of the newest segment that holds it.
+        Segments that cannot hold the key are not searched, the searches that have not started yet are cancelled once the result is known.
+        """
+        searches = [
+            read_pool.submit(
+                self._find_record_in_segment, encoded_key, segment, generation
+            )
+            for segment in reversed(segments)
+            if self._segment_may_hold(segment, encoded_key, hashes, shard)
+        ]
+        try:
+            for search in searches:
+                item = search.result()
+                if item is not None:
+                    # a tombstone is the latest write of the key, older segments do not matter
+                    return None if item[0] is TOMBSTONE else item[0]
+        finally:
+            for search in searches:
+                search.cancel()
         return None
 
     def put(self, key: str, value: U):
-        self._memtable.update({key: value})
+        # keys are interned, so repeated writes of a key share one string and dict lookups
+        # of the same key hit the identity fast path
+        key = sys.intern(key)
+        encoded_key = key.encode("utf-8")
+        self._append_to_wal(encoded_key, value)
+        self._update_memtable(key, encoded_key, value)
         if self._is_memtable_over_threshold():
-            self._flush_memtable()
+            # the memtable is written in the background, put only waits for a previous flush to finish
+            self._start_flush(compact=True)
 
     def delete(self, key):
-        self._memtable.update({key: "tombstone"})
+        key = sys.intern(key)
+        encoded_key = key.encode("utf-8")
+        self._append_to_wal(encoded_key, TOMBSTONE)
+        self._update_memtable(key, encoded_key, TOMBSTONE)
+
+    def close(self):
+        """
+        Stops the background threads, syncs and closes the write-ahead log.
+        The memtable is not flushed, it is replayed from the log when the tree is opened again.
+        """
+        if self._wal_closed:
+            return
+        self._stop_merge_scheduler()
+        with self._flush_lock:
+            self._wait_for_pending_flush()
+        if self._compaction_pool is not None:
+            self._compaction_pool.shutdown()
+        with self._wal_lock:
+            self._sync_wal_locked()
+            os.close(self._wal_fd)
+            self._wal_closed = True
+        # wake the syncer up so it sees the log is closed
+        self._wal_unsynced.set()
+        self._wal_syncer.join()
+        self._background_flusher.shutdown()
+        self._flush_executor.shutdown()
+        if self._read_pool is not None:
+            self._read_pool.shutdown()
+
+    def _wal_id_from_path(self, path: str) -> int:
+        return int(os.path.basename(path)[len("wal_") : -len(".log")])
+
+    def _open_wal(self) -> int:
+        path = os.path.join(self._storage_location, f"wal_{self._wal_id}.log")
+        self._wal_paths.append(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # the log is only found again after a crash if its directory entry is on disk
+        self._sync_directory()
+        return fd
+
+    def _sync_directory(self):
+        """
+        Syncs the storage directory, so the files created in it since the last sync survive a crash.
+        Syncing a file only makes its data durable, not its name.
+        """
+        if _O_DIRECTORY is None:
+            return
+        fd = os.open(self._storage_location, os.O_RDONLY | _O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _append_to_wal(self, encoded_key: bytes, value: U | Tombstone):
+        """
+        Appends a write to the write-ahead log.
+        The log is synced once every wal_sync_batch writes, or by the syncer thread
+        at most wal_sync_interval seconds after a write, instead of once per write.
+        """
+        record = pack_record(encoded_key, value)
+        with self._wal_lock:
+            os.write(self._wal_fd, record)
+            self._wal_pending += 1
+            if self._wal_pending >= self._wal_sync_batch:
+                self._sync_wal_locked()
+            else:
+                self._wal_unsynced.set()
+
+    def _sync_wal_locked(self):
+        if self._wal_pending:
+            _fdatasync(self._wal_fd)
+            self._wal_pending = 0
+        self._wal_unsynced.clear()
+
+    def _run_wal_syncer(self):
+        while True:
+            self._wal_unsynced.wait()
+            time.sleep(self._wal_sync_interval)
+            with self._wal_lock:
+                if self._wal_closed:
+                    return
+                self._sync_wal_locked()
+
+    def _replay_wal(self):
+        """
+        Replays the write-ahead logs left by a previous run into the memtable.
+        A partially written record at the end of a log is ignored.
+        """
+        for path in self._wal_paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                try:
+                    key, value, _, next_offset = read_record(data, offset)
+                except (struct.error, IndexError, UnicodeDecodeError, TypeError):
+                    break
+                if next_offset > len(data):
+                    break
+                key = sys.intern(key)
+                self._update_memtable(key, key.encode("utf-8"), value)
+                offset = next_offset
+
+    def _rotate_wal(self) -> list[str]:
+        """
+        Starts a new write-ahead log for the next memtable generation.
+        Returns the paths of the logs of the memtable being flushed, to delete once it is on disk.
+        """
+        with self._wal_lock:
+            self._sync_wal_locked()
+            os.close(self._wal_fd)
+            flushed_wal_paths = self._wal_paths
+            self._wal_paths = []
+            self._wal_id += 1
+            self._wal_fd = self._open_wal()
+        return flushed_wal_paths
+
+    def _shard_for(self, key: str) -> int:
+        """
+        Returns the memtable shard of a key.
+        str hashes are cached on the object and randomized per process,
+        so shards are only meaningful within the running process.
+        """
+        return hash(key) % self._memtable_shards
+
+    def _update_memtable(self, key: str, encoded_key: bytes, value: U | Tombstone):
+        """
+        Writes an item to its memtable shard, keeping the memtable size estimate up to date.
+        Short string values are deduplicated, so repeated payloads, from put or the write-ahead log,
+        share one object across keys. They are not interned with sys.intern, interned strings are never freed
+        on recent Python versions. The values are deduplicated through a dict of at most _MAX_INTERNED_VALUES
+        of them, dropped with the memtable when it is flushed.
+        """
+        if type(value) is str and len(value) <= _MAX_INTERNED_VALUE_LENGTH:
+            memtable_values = self._memtable_values
+            if len(memtable_values) < _MAX_INTERNED_VALUES:
+                value = memtable_values.setdefault(value, value)
+            else:
+                value = memtable_values.get(value, value)
+        memtable = self._memtables[self._shard_for(key)]
+        previous_value = memtable.get(key)
+        if previous_value is None:
+            # the key and the rough Python object overhead are only added once per key
+            self._memtable_bytes += len(encoded_key) + 48
+        else:
+            self._memtable_bytes -= self._estimate_value_size(previous_value)
+        self._memtable_bytes += self._estimate_value_size(value)
+        memtable[key] = value
 
     def _is_memtable_over_threshold(self):
-        return asizeof.asizeof(self._memtable) > self._memtable_max_size
+        return self._memtable_bytes > self._memtable_max_size
+
+    def _estimate_value_size(self, value: U | Tombstone) -> int:
+        """
+        Estimates the memory used by a value in the memtable from its encoded size,
+        4 bytes for an int, 8 for a float and the utf-8 length of a string.
+        Numbers are not formatted to a string to be measured, and an ascii string, which is checked
+        without scanning it, is not encoded, its utf-8 length is its length.
+        """
+        if isinstance(value, str):
+            return len(value) if value.isascii() else len(value.encode("utf-8"))
+        return 8 if isinstance(value, float) else 4
 
     def _flush_memtable(self):
         """
-        Flushes the memtable to disk and creates a new memtable.
+        Flushes the memtable shards to disk and waits for the flush to finish.
         """
+        flush = self._start_flush(compact=False)
+        if flush is not None:
+            flush.result()
 
-        # provide new memtable to receive new writes
-        self.memtable_being_flushed = self._memtable
-        self._memtable = SortedDict()
+    def _start_flush(self, compact: bool) -> Future | None:
+        """
+        Hands the memtable shards to the background flusher and creates a new memtable.
+        A flush still running is waited for first, so at most one memtable is being flushed
+        and memory stays bounded. get reads the memtable being flushed until its segments are added.
+        If compact is set, a background compaction may start once the segments are added.
+        Returns the future of the flush, or None if the memtable is empty.
+        """
+        with self._flush_lock:
+            self._wait_for_pending_flush()
+            if not any(self._memtables):
+                return None
 
-        self._last_sstable_id += 1
-        data_segment_name = f"storage/segment_{self._last_sstable_id}"
+            # provide new memtable shards to receive new writes
+            self._memtables_being_flushed = self._memtables
+            self._memtables = [{} for _ in range(self._memtable_shards)]
+            self._memtable_bytes = 0
+            self._memtable_values = {}
+            flushed_wal_paths = self._rotate_wal()
 
-        offsets = self._write_dict_to_data_segment(
-            data_segment_name, self.memtable_being_flushed
-        )
-        self._data_segments.append((data_segment_name, offsets))
-        self.memtable_being_flushed.clear()
-
-    def _write_dict_to_data_segment(
-        self, data_segment_name: str, dict_to_write: dict
-    ) -> dict:
-        """
-        Writes a dictionary to a data segment and returns the a sparse index of the keys in the segment.
-        """
-        current_block_size = 0
-        is_first_block = True
-        offsets = {}
-        with open(data_segment_name, "wb") as f:
-            for key, value in dict_to_write.items():
-                if is_first_block:
-                    # if is_first_block, then we need to add the offset of the first block
-                    offsets[key] = 0
-                    is_first_block = False
-
-                format_string = self._generate_struct_format_string(str(key), value)
-
-                if (
-                    current_block_size + struct.calcsize(format_string)
-                    > self._sstable_block_size
-                ):
-                    # if the current block size + the size of the new key value pair is greater than the block size,
-                    # then we need to start a new block
-                    f.flush()
-                    offsets[key] = f.tell()
-                    current_block_size = struct.calcsize(format_string)
-                else:
-                    current_block_size += struct.calcsize(format_string)
-
-                encoded_key = str(key).encode("utf-8")
-                key_length = len(encoded_key)
-                type_char = (
-                    "i"
-                    if isinstance(value, int)
-                    else "d"
-                    if isinstance(value, float)
-                    else "s"
-                )
-                if isinstance(value, int) or isinstance(value, float):
-                    f.write(
-                        struct.pack(
-                            format_string,
-                            key_length,
-                            encoded_key,
-                            value == "tombstone",
-                            type_char.encode("utf-8"),
-                            value,
-                        )
-                    )
-                else:
-                    encoded_value = str(value).encode("utf-8")
-                    value_length = len(encoded_value)
-                    f.write(
-                        struct.pack(
-                            format_string,
-                            key_length,
-                            encoded_key,
-                            value == "tombstone",
-                            type_char.encode("utf-8"),
-                            value_length,
-                            encoded_value,
-                        )
+            shards_to_flush = []
+            for shard, memtable in enumerate(self._memtables_being_flushed):
+                if memtable:
+                    self._last_sstable_id += 1
+                    data_segment_name = os.path.join(
+                        self._storage_location, f"segment_{self._last_sstable_id}"
                     )
-        return offsets
+                    shards_to_flush.append((data_segment_name, shard, memtable))
+
+            self._pending_flush = self._background_flusher.submit(
+                self._write_flushed_memtables,
+                shards_to_flush,
+                flushed_wal_paths,
+                compact,
+            )
+            return self._pending_flush
 
-    def _generate_struct_format_string(self, key: str, value: U) -> str:
+    def _wait_for_pending_flush(self):
         """
-        Builds the format string for the serialization of the key and value.
-        Order is key_length, key, tombstone, value_type, value_length(if str), value.
+        Waits for the running flush to finish, raising its error if it failed. Called with _flush_lock held.
         """
-        key_length = len(str(key).encode("utf-8"))
+        if self._pending_flush is not None:
+            flush, self._pending_flush = self._pending_flush, None
+            flush.result()
 
-        if isinstance(value, int):
-            return ">i{}s?ci".format(key_length)
-        elif isinstance(value, float):
-            return ">i{}s?cd".format(key_length)
-        elif isinstance(value, str):
-            value_length = len(str(value).encode("utf-8"))
-            return ">i{}s?ci{}s".format(key_length, value_length)
-        else:
-            raise (TypeError("Unsupported type for value"))
+    def _write_flushed_memtables(
+        self,
+        shards_to_flush: list[tuple[str, int, dict[str, U | Tombstone]]],
+        flushed_wal_paths: list[str],
+        compact: bool,
+    ):
+        """
+        Writes the memtable shards being flushed to disk, one data segment per non-empty shard
+        written in parallel, and adds the segments to the tree.
+        The shards are first serialized to in-memory segments, which replace the memtable being flushed
+        for reads, so its Python objects are released before the disk writes. The segments are then written
+        to their files and replaced by their memory maps.
+        Every segment syncs its own data, the names of all of them are committed together
+        by a single sync of the storage directory.
+        """
+        segments = self._flush_executor.map(
+            lambda flush: self._serialize_memtable_shard(*flush), shards_to_flush
+        )
+        in_memory_segments = [segment for segment in segments if segment is not None]
+        with self._segments_lock:
+            self._data_segments = self._data_segments + in_memory_segments
+        self._memtables_being_flushed = [{} for _ in range(self._memtable_shards)]
+
+        written_segments = {
+            segment.name: segment
+            for segment in self._flush_executor.map(
+                self._write_in_memory_segment, in_memory_segments
+            )
+        }
+        self._sync_directory()
+        with self._segments_lock:
+            # the list is replaced instead of mutated, like a compaction does
+            self._data_segments = [
+                written_segments.get(segment.name, segment)
+                for segment in self._data_segments
+            ]
+        # the segments are synced to disk, the logs of the flushed memtable are no longer needed
+        for path in flushed_wal_paths:
+            os.remove(path)
+        if compact:
+            self._request_compaction()
 
-    def _find_block_range_for_key(
-        self, key: str, block_offsets: dict
-    ) -> tuple[str | None, str | None]:
+    def _serialize_memtable_shard(
+        self, data_segment_name: str, shard: int, memtable: dict[str, U | Tombstone]
+    ) -> Segment | None:
         """
-        Returns the offsets of the SSTable blocks that bound the key in the segment.
+        Serializes a memtable shard to an in-memory segment, with the layout of a segment file,
+        to be written to data_segment_name. Returns None if the shard is empty.
         """
-        block_offset_keys = list(block_offsets.keys())
-        position = bisect.bisect_left(block_offset_keys, key)
+        buffer = io.BytesIO()
+        block_keys, block_starts, max_key, bloom, written = _pack_data_segment(
+            buffer,
+            # the memtable is only sorted once, when it is flushed, utf-8 preserves the order of the keys
+            sorted((key.encode("utf-8"), value) for key, value in memtable.items()),
+            len(memtable),
+            self._sstable_block_size,
+        )
+        if not written:
+            return None
+        return Segment(
+            data_segment_name,
+            block_keys,
+            block_starts,
+            max_key,
+            bloom,
+            buffer.getvalue(),
+            written,
+            None if self._memtable_shards == 1 else shard,
+        )
 
-        lower_bound = (
-            block_offset_keys[position - 1]
-            if position in range(1, len(block_offset_keys) + 1)
-            else block_offset_keys[position]
-            if position == 0
-            else None
+    def _write_in_memory_segment(self, segment: Segment) -> Segment:
+        """
+        Writes an in-memory segment to its file with a single write, syncs it and persists its bloom filter,
+        and returns the segment read from a memory map of the file.
+        """
+        with _synced_file(segment.name) as f:
+            f.write(segment.data)
+        # the bloom filter of an in-memory segment is always held in memory
+        bloom = cast(BloomFilter, segment.bloom)
+        _write_bloom(segment.name, bloom)
+        return segment._replace(
+            bloom=self._cache_bloom(segment.name, bloom),
+            data=_map_file(segment.name, _MADV_RANDOM),
+        )
+
+    def _write_items_to_data_segment(
+        self,
+        data_segment_name: str,
+        items: Iterable[tuple[bytes, U | Tombstone]],
+        expected_item_count: int,
+    ) -> Segment | None:
+        """
+        Writes items, sorted by encoded key, to a data segment and returns the segment, see _write_data_segment_file.
+        If there are no items, no segment is written and None is returned.
+        """
+        segment_file = _write_data_segment_file(
+            data_segment_name, items, expected_item_count, self._sstable_block_size
         )
-        upper_bound = (
-            block_offset_keys[position] if position != len(block_offset_keys) else None
+        if segment_file is None:
+            return None
+        return self._map_segment_file(segment_file)
+
+    def _map_segment_file(self, segment_file: SegmentFile) -> Segment:
+        """
+        Memory maps a written data segment file to read it, advised for the random reads of point lookups.
+        """
+        data = _map_file(segment_file.name, _MADV_RANDOM)
+        return Segment(
+            segment_file.name,
+            segment_file.block_keys,
+            segment_file.block_starts,
+            segment_file.max_key,
+            self._cache_bloom(segment_file.name, segment_file.bloom),
+            data,
+            segment_file.size,
         )
 
-        return lower_bound, upper_bound
+    def _load_data_segments(self):
+        """
+        Loads the data segments left in the storage location by a previous run,
+        rebuilding their sparse indexes and bloom filters, and resumes the segment ids after theirs.
+        The merged segment is the oldest, the other segments follow in the order they were flushed.
+        """
+        merged_names = glob.glob(
+            os.path.join(self._storage_location, "merged_segment_*")
+        )
+        names = glob.glob(os.path.join(self._storage_location, "segment_*"))
+        # the bloom filters are loaded with their segments
+        merged_names = [name for name in merged_names if not name.endswith(".bf")]
+        names = [name for name in names if not name.endswith(".bf")]
+        merged_names.sort(key=self._segment_id_from_path)
+        names.sort(key=self._segment_id_from_path)
+        if merged_names:
+            self._last_merged_sstable_id = self._segment_id_from_path(merged_names[-1])
+        if names:
+            self._last_sstable_id = self._segment_id_from_path(names[-1])
 
-    def _find_item_in_segment(
-        self, key: str, segment: tuple[str, dict]
-    ) -> tuple[U, int] | None:
+        segments = []
+        for data_segment_name in merged_names + names:
+            segment = self._open_data_segment(data_segment_name)
+            if segment is not None:
+                segments.append(segment)
+        self._data_segments = segments
+
+    def _segment_id_from_path(self, path: str) -> int:
+        return int(path.rsplit("_", 1)[1])
+
+    def _read_bloom(self, data_segment_name: str) -> BloomFilter | None:
         """
-        Finds an item in the given segment. If the key is not found, returns None.
-        If the key is in the sparse index and not tombstoned, then the value is read directly from the block.
-        If not, get the block range that bounds the key and read the file between the lower and upper bound offsets and find the key.
-        Return value and offset of the item in the segment.
+        Reads the persisted bloom filter of a data segment, or returns None if it is missing or truncated.
         """
-        segment_name, block_offsets = segment
-        if key in block_offsets:
-            # if key is part of sparse index, navigate to the block offset and read the key and value
-            with open(segment_name, "rb") as f:
-                f.seek(block_offsets[key])
-                key_read, value, is_tombstoned = self._read_item_from_disk(f)
-                if not is_tombstoned:
-                    return (value, block_offsets[key])
-
-        lower_bound, upper_bound = self._find_block_range_for_key(key, block_offsets)
-        if lower_bound is None:
-            # if lower_bound is None, then the key does not exist in the segment
+        try:
+            with open(_bloom_path(data_segment_name), "rb") as f:
+                return BloomFilter.from_bytes(f.read())
+        except (FileNotFoundError, ValueError):
             return None
-        else:
-            with open(segment_name, "rb") as f:
-                current_block_offset = block_offsets[lower_bound]
-                while not self._is_EOF(f):
-                    f.seek(current_block_offset)
-
-                    (
-                        current_key,
-                        current_value,
-                        is_tombstoned,
-                    ) = self._read_item_from_disk(f)
-
-                    if key == current_key and not is_tombstoned:
-                        return (current_value, current_block_offset)
-                    elif upper_bound is not None and upper_bound < current_key:
-                        # if we passed the upper bound, then the key does not exist in the segment
-                        return None
-                    current_block_offset = f.tell()
-        return None
 
-    def _is_EOF(self, file: BinaryIO) -> bool:
-        next_byte = file.read(1)
-        if next_byte != b"":
-            # if next_byte is not empty, restore the file pointer
-            file.seek(-1, 1)
-        return next_byte == b""
-
-    def _read_item_from_disk(self, file: BinaryIO) -> tuple[str, U, bool]:
-        """
-        Reads a key, value, and tombstone bit from the file.
-        File pointer must be at the start of the key.
-        """
-        key_length = struct.unpack(">i", file.read(4))[0]
-        key = struct.unpack(f">{key_length}s", file.read(key_length))[0].decode("utf-8")
-        is_tombstoned = struct.unpack(">?", file.read(1))[0]
-        value_type = struct.unpack(">c", file.read(1))[0].decode("utf-8")
-        if value_type == "s":
-            value_length = struct.unpack(">i", file.read(4))[0]
-            value: U = str(
-                struct.unpack(f">{value_length}s", file.read(value_length))[0].decode(
-                    "utf-8"
-                )
+    def _cache_bloom(
+        self, data_segment_name: str, bloom: BloomFilter
+    ) -> BloomFilter | CachedBloomFilter:
+        """
+        Returns the bloom filter a data segment holds for its persisted bloom filter: the filter itself
+        without a bloom filter cache, otherwise a filter loaded through the cache, which starts with the filter.
+        """
+        if self._bloom_cache is None:
+            return bloom
+        path = _bloom_path(data_segment_name)
+        self._bloom_cache.put(path, bloom)
+        return CachedBloomFilter(path, bloom.capacity, self._bloom_cache)
+
+    def _remove_data_segment_files(self, data_segment_name: str):
+        os.remove(data_segment_name)
+        if os.path.exists(_bloom_path(data_segment_name)):
+            os.remove(_bloom_path(data_segment_name))
+        if self._bloom_cache is not None:
+            self._bloom_cache.discard(_bloom_path(data_segment_name))
+
+    def _open_data_segment(self, data_segment_name: str) -> Segment | None:
+        """
+        Opens a data segment written by _write_items_to_data_segment.
+        The sparse index is rebuilt from the records, the bloom filter is read from its file
+        and only rebuilt if the file is missing.
+        A segment that is empty or ends in a partial record was not completely written,
+        its items are still in the write-ahead log or in the segments it was merged from,
+        so it is deleted and None is returned.
+        """
+        size = os.path.getsize(data_segment_name)
+        if not size:
+            self._remove_data_segment_files(data_segment_name)
+            return None
+        # the whole segment is scanned once to rebuild its index, then only read by point lookups
+        data = _map_file(data_segment_name, _MADV_SEQUENTIAL)
+
+        bloom = self._read_bloom(data_segment_name)
+        block_keys: list[bytes] = []
+        block_starts = array.array("Q")
+        keys: list[bytes] = []
+        max_key = b""
+        offset = 0
+        try:
+            while offset < size:
+                key, _, _, next_offset = read_raw_record(data, offset)
+                if next_offset > size:
+                    raise struct.error("partial record")
+                if not block_starts or (
+                    next_offset - block_starts[-1] > self._sstable_block_size
+                ):
+                    block_keys.append(key)
+                    block_starts.append(offset)
+                if bloom is None:
+                    keys.append(key)
+                max_key = key
+                offset = next_offset
+        except (struct.error, IndexError, UnicodeDecodeError, TypeError):
+            block_starts = array.array("Q")
+
+        if not block_starts:
+            data.close()
+            self._remove_data_segment_files(data_segment_name)
+            return None
+        if bloom is None:
+            bloom = BloomFilter(len(keys))
+            for key in keys:
+                bloom.add(key)
+            _write_bloom(data_segment_name, bloom)
+        _advise(data, _MADV_RANDOM)
+        return Segment(
+            data_segment_name,
+            block_keys,
+            block_starts,
+            max_key,
+            self._cache_bloom(data_segment_name, bloom),
+            data,
+            size,
+        )
+
+    def _find_blocks_for_keys(
+        self, sorted_keys: Iterable[bytes], segment: Segment
+    ) -> Iterator[tuple[bytes, tuple[int, int]]]:
+        """
+        Yields every key of sorted_keys that is not before the first block of the segment, in order,
+        with the start and end offsets of the block that may hold it, like _find_block_for_key.
+        Each key is bisected from the block of the previous key on, so the keys are matched to the blocks
+        in a single forward pass over the index.
+        """
+        block_keys = segment.block_keys
+        block_starts = segment.block_starts
+        block_count = len(block_keys)
+        position = 0
+        for key in sorted_keys:
+            position = bisect.bisect_right(block_keys, key, position)
+            if position == 0:
+                continue
+            block_end = (
+                block_starts[position] if position < block_count else segment.size
             )
-        elif value_type == "i":
-            value = int(struct.unpack(">i", file.read(4))[0])
-        elif value_type == "d":
-            value = float(struct.unpack(">d", file.read(8))[0])
-        else:
-            raise (TypeError("Unsupported type for value"))
+            yield key, (block_starts[position - 1], block_end)
+
+    def _find_block_for_key(
+        self, key: bytes, segment: Segment
+    ) -> tuple[int, int] | None:
+        """
+        Returns the start and end offsets of the SSTable block that may hold the key in the segment,
+        or None if the key is before the first block. The block is found by bisecting the sorted
+        first keys of the blocks, without building any list.
+        """
+        index = bisect.bisect_right(segment.block_keys, key) - 1
+        if index < 0:
+            return None
+        block_starts = segment.block_starts
+        next_index = index + 1
+        block_end = (
+            block_starts[next_index] if next_index < len(block_starts) else segment.size
+        )
+        return block_starts[index], block_end
+
+    def _find_item_in_segment(self, key: str, segment: Segment) -> tuple[U, int] | None:
+        """
+        Finds an item in the given segment. If the key is not found or is tombstoned, returns None.
+        The bloom filter of the segment is checked first, a key it rules out loads no block.
+        Return value and offset of the item in the segment.
+        """
+        encoded_key = key.encode("utf-8")
+        if encoded_key not in segment.bloom:
+            return None
+        item = self._find_record_in_segment(encoded_key, segment)
+        if item is None:
+            return None
+        value, _, offset = item
+        if value is TOMBSTONE:
+            return None
+        return (value, offset)
+
+    def _find_record_in_segment(
+        self, encoded_key: bytes, segment: Segment, generation: int | None = None
+    ) -> tuple[U | Tombstone, bool, int] | None:
+        """
+        Finds the record of an encoded key in the given segment, tombstoned or not. If the key is not found, returns None.
+        Gets the block that may hold the key, loads it and looks the key up in it.
+        Returns value, tombstone bit and offset of the item in the segment.
+        """
+        block_range = self._find_block_for_key(encoded_key, segment)
+        if block_range is None:
+            # the key is before the first block, it does not exist in the segment
+            return None
+        return self._load_segment_block(segment, block_range, generation).get(
+            encoded_key
+        )
+
+    def _load_segment_block(
+        self,
+        segment: Segment,
+        block_range: tuple[int, int],
+        generation: int | None = None,
+    ) -> dict[bytes, tuple[U | Tombstone, bool, int]]:
+        """
+        Loads the block of the segment between its start and end offsets through the block cache.
+        generation is the segments generation the segment was read from. If a compaction replaced the segments
+        since, the segment may have been removed and its blocks are not cached, so the cache does not keep
+        the memory map of a removed segment alive.
+        The blocks of an in-memory segment are not cached either, so the cache does not keep the serialized
+        segment alive once it is replaced by its file.
+        """
+        block_start, block_end = block_range
+        if segment.in_memory or (
+            generation is not None and generation != self._segments_generation
+        ):
+            return self._read_block(segment.data, block_start, block_end)
+        block = self._load_block(segment.data, block_start, block_end)
+        if generation is not None and generation != self._segments_generation:
+            # a compaction cleared the cache while the block was being loaded
+            with self._segments_lock:
+                self._load_block.cache_clear()
+        return block
 
-        return str(key), value, bool(is_tombstoned)
+    def _read_block(
+        self, data: mmap.mmap | bytes, block_start: int, block_end: int
+    ) -> dict[bytes, tuple[U | Tombstone, bool, int]]:
+        """
+        Parses every item of a block into a dict of encoded key to value, tombstone bit and offset in the segment.
+        Keys are not decoded, get looks them up by their encoded key.
+        The block is copied out of the memory map with a single slice and parsed from the copy,
+        the loop ends at the end of the copy, so no end of file check is needed.
+        Called through the _load_block block cache.
+        """
+        block = {}
+        block_data = data[block_start:block_end]
+        offset = 0
+        while offset < len(block_data):
+            item_offset = offset
+            key, value, is_tombstoned, offset = read_raw_record(block_data, offset)
+            block[key] = (value, is_tombstoned, block_start + item_offset)
+        return block
 
-    def _mark_item_as_tombstoned(self, segment_name: str, offset: int):
+    def _iter_segment(
+        self, segment: Segment, rank: int
+    ) -> Iterator[tuple[bytes, int, U | Tombstone]]:
         """
-        Marks the item at the given offset in the segment as tombstoned.
+        Yields the encoded key, rank and value of every item in the segment, in key order.
+        Keys are merged and written back encoded, they are never decoded.
+        rank is the age of the segment in the merge, 0 for the newest. Every segment has its own,
+        so the items are merged by plain tuple comparison, the newest first for equal keys,
+        without a key function and without ever comparing values.
         """
-        with open(segment_name, "r+b") as f:
-            key_length = struct.unpack(">i", f.read(4))[0]
-            f.seek(offset + 4 + key_length)
-            f.write(struct.pack(">?", True))
+        data = segment.data
+        # the segment is read through once, while it still serves point lookups
+        _advise(data, _MADV_SEQUENTIAL)
+        try:
+            offset = 0
+            while offset < segment.size:
+                key, value, _, offset = read_raw_record(data, offset)
+                yield key, rank, value
+        finally:
+            # if the merge fails or stops early, the segment is kept and read by point lookups again
+            _advise(data, _MADV_RANDOM)
 
     def _merge_and_compact(self):
         """
-        Merges all data segments into a single segment and deletes the old segments.
-        Duplicate keys are resolved by taking the value from the segment with the highest priority.
+        Merges a snapshot of all data segments into a single segment and deletes the old segments.
+        The segments are streamed through a k-way merge, newest segment first, so for duplicate keys
+        the first item of each run is the most recent one and the rest are skipped.
         Tombstoned keys are not added to the merged segment.
+        With compaction_processes, the key ranges are merged in parallel into one segment each instead.
+        Segments flushed while merging are kept, after the merged segments.
+        """
+        with self._compaction_lock:
+            # segments still being written by a flush are only merged once they are on disk,
+            # they are the most recent segments, so the snapshot is the oldest segments
+            segments = [
+                segment for segment in self._data_segments if not segment.in_memory
+            ]
+            if len(segments) <= 1:
+                return
+
+            if self._compaction_processes:
+                merged_segments = self._merge_key_ranges(segments)
+            else:
+                merged_items = heapq.merge(
+                    *(
+                        self._iter_segment(segment, rank)
+                        for rank, segment in enumerate(reversed(segments))
+                    )
+                )
+                merged_segment = self._write_items_to_data_segment(
+                    self._next_merged_segment_name(),
+                    _latest_live_items(merged_items),
+                    sum(segment.bloom.capacity for segment in segments),
+                )
+                merged_segments = [merged_segment] if merged_segment is not None else []
+
+            # the merged segments must survive a crash before the segments they replace are removed
+            self._sync_directory()
+            merged_names = {segment.name for segment in segments}
+            with self._segments_lock:
+                self._data_segments = merged_segments + [
+                    s for s in self._data_segments if s.name not in merged_names
+                ]
+                self._segments_generation += 1
+                # cached blocks reference the maps of the old segments
+                self._load_block.cache_clear()
+            for segment in segments:
+                # the maps are not closed explicitly, a concurrent get may still be reading them,
+                # they are released once the last reference to the old segment is dropped
+                self._remove_data_segment_files(segment.name)
+
+    def _next_merged_segment_name(self) -> str:
+        self._last_merged_sstable_id += 1
+        return os.path.join(
+            self._storage_location, f"merged_segment_{self._last_merged_sstable_id}"
+        )
+
+    def _merge_key_ranges(self, segments: list[Segment]) -> list[Segment]:
         """
-        if len(self._data_segments) > 1:
-            self._last_merged_sstable_id += 1
-            merged_data_segment_name = (
-                f"storage/merged_segment_{self._last_merged_sstable_id}"
+        Splits the key space of the segments into compaction_processes ranges and merges every range
+        in its own process into its own segment, see _merge_segment_range. The ranges are disjoint,
+        so the segments they are merged into never hold the same key and can be read in any order.
+        The range bounds are quantiles of the first keys of the blocks of the segments, so each range
+        covers about as many blocks.
+        If a range fails, the ranges not started yet are cancelled and the segments written by the others removed
+        before the error is raised.
+        """
+        block_keys = sorted(key for segment in segments for key in segment.block_keys)
+        bounds = sorted(
+            {
+                block_keys[len(block_keys) * i // self._compaction_processes]
+                for i in range(1, self._compaction_processes)
+            }
+        )
+        lows: list[bytes | None] = [None, *bounds]
+        highs: list[bytes | None] = [*bounds, None]
+        sources = [
+            (segment.name, segment.block_keys, segment.block_starts)
+            for segment in reversed(segments)
+        ]
+        # ranges are sized alike, so the items are spread evenly across their bloom filters
+        expected_item_count = -(
+            -sum(segment.bloom.capacity for segment in segments) // len(lows)
+        )
+
+        if self._compaction_pool is None:
+            # compaction processes are spawned, not forked, the tree runs other threads
+            self._compaction_pool = ProcessPoolExecutor(
+                max_workers=self._compaction_processes,
+                mp_context=multiprocessing.get_context("spawn"),
             )
-            merged_values = SortedDict()
-
-            for segment in self._data_segments:
-                with open(segment[0], "rb") as f:
-                    while not self._is_EOF(f):
-                        key, value, is_tombstoned = self._read_item_from_disk(f)
-                        if not is_tombstoned:
-                            merged_values.update({key: value})
-                        elif key in merged_values:
-                            merged_values.pop(key)
-                os.remove(segment[0])
-
-            offsets = self._write_dict_to_data_segment(
-                merged_data_segment_name, merged_values
+        names = [self._next_merged_segment_name() for _ in lows]
+        merges = [
+            self._compaction_pool.submit(
+                _merge_segment_range,
+                name,
+                sources,
+                low,
+                high,
+                expected_item_count,
+                self._sstable_block_size,
             )
-            self._data_segments = [(merged_data_segment_name, offsets)]
+            for name, low, high in zip(names, lows, highs)
+        ]
+        try:
+            segment_files = [merge.result() for merge in merges]
+        except BaseException:
+            for merge in merges:
+                merge.cancel()
+            # the ranges already running may still write their segments
+            wait(merges)
+            for name in names:
+                if os.path.exists(name):
+                    self._remove_data_segment_files(name)
+            raise
+        return [
+            self._map_segment_file(segment_file)
+            for segment_file in segment_files
+            if segment_file is not None
+        ]
+
+    def _request_compaction(self):
+        """
+        Wakes the merge scheduler up to compact the data segments if there are more than compaction_threshold of them.
+        Writes keep going to the memtable and new segments while it runs.
+        """
+        if len(self._data_segments) <= self._compaction_threshold:
+            return
+        with self._merge_condition:
+            self._merge_requested = True
+            self._merge_condition.notify()
+
+    def _run_merge_scheduler(self):
+        """
+        Compacts the data segments every merge_interval seconds, and as soon as a compaction is requested.
+        The thread sleeps on the merge condition in between, an idle tree is only woken up by the interval.
+        A compaction that fails is reported and the next one is still run, the segments it would have merged
+        are left as they are.
+        """
+        while True:
+            with self._merge_condition:
+                self._merge_condition.wait_for(
+                    lambda: self._merge_requested or self._merge_stopped,
+                    timeout=self._merge_interval,
+                )
+                if self._merge_stopped:
+                    return
+                self._merge_requested = False
+            try:
+                self._merge_and_compact()
+            except Exception as e:
+                print(f"Failed to compact the data segments: {e!r}")
 
     def _stop_merge_scheduler(self):
-        self._merge_scheduler.cancel()
+        """
+        Stops the merge scheduler, waiting for a running compaction to finish.
+        """
+        with self._merge_condition:
+            self._merge_stopped = True
+            self._merge_condition.notify()
+        self._merge_scheduler.join()
@@ -0,0 +1,37 @@
+import socket
+import struct
+
+# every message is prefixed with its length as a 4 byte big-endian unsigned int
+HEADER = struct.Struct(">I")
+# the largest message a peer may announce, larger frames close the connection
+MAX_MESSAGE_SIZE = 64 << 20
+
+
+def encode_message(payload: bytes) -> bytes:
+    """
+    Frames a payload with its length prefix.
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytearray:
+    """
+    Receives exactly size bytes from a blocking socket into a single buffer.
+    Raises ConnectionError if the peer closes the connection first.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("connection closed by peer")
+        received += count
+    return buffer
+
+
+def recv_message(sock: socket.socket) -> bytearray:
+    """
+    Receives one length-prefixed message from a blocking socket and returns its payload.
+    """
+    return recv_exact(sock, HEADER.unpack(recv_exact(sock, HEADER.size))[0])
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import enum
+import functools
+import struct
+from typing import Any, Callable, Final, Union
+
+U = Union[int, float, str]
+
+
+class Tombstone(enum.Enum):
+    """
+    The value of a deleted key. Its only member, TOMBSTONE, is a singleton checked by identity.
+    """
+
+    TOMBSTONE = "TOMBSTONE"
+
+
+TOMBSTONE: Final = Tombstone.TOMBSTONE
+
+_KEY_LENGTH = struct.Struct(">i")
+_KEY_LENGTH_SIZE = _KEY_LENGTH.size
+# value types by their byte in a record, indexing bytes gives the int value of the byte
+_VALUE_TYPES: dict[int, bytes] = {
+    ord(value_type): value_type for value_type in (b"i", b"d", b"s")
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _tombstone_struct(key_length: int) -> struct.Struct:
+    """
+    Returns the precompiled struct of a tombstone record for a key length:
+    key length, key and the tombstone bit, a tombstone has no value type or value.
+    """
+    return struct.Struct(f">i{key_length}s?")
+
+
+@functools.lru_cache(maxsize=4096)
+def _record_struct(value_type: bytes, key_length: int) -> struct.Struct:
+    """
+    Returns the precompiled struct of a record for a value type and key length:
+    key length, key, tombstone, value type and a double value, an int value or the length of a string value.
+    The bytes of a string value follow the struct.
+    """
+    value_format = "d" if value_type == b"d" else "i"
+    return struct.Struct(f">i{key_length}s?c{value_format}")
+
+
+def _pack_int(encoded_key: bytes, value: int, is_tombstoned: bool) -> bytes:
+    key_length = len(encoded_key)
+    return _record_struct(b"i", key_length).pack(
+        key_length, encoded_key, is_tombstoned, b"i", value
+    )
+
+
+def _pack_double(encoded_key: bytes, value: float, is_tombstoned: bool) -> bytes:
+    key_length = len(encoded_key)
+    return _record_struct(b"d", key_length).pack(
+        key_length, encoded_key, is_tombstoned, b"d", value
+    )
+
+
+def _pack_str(encoded_key: bytes, value: str, is_tombstoned: bool) -> bytes:
+    key_length = len(encoded_key)
+    encoded_value = value.encode("utf-8")
+    return (
+        _record_struct(b"s", key_length).pack(
+            key_length, encoded_key, is_tombstoned, b"s", len(encoded_value)
+        )
+        + encoded_value
+    )
+
+
+def _pack_tombstone(encoded_key: bytes, value: Any, is_tombstoned: bool) -> bytes:
+    key_length = len(encoded_key)
+    return _tombstone_struct(key_length).pack(key_length, encoded_key, True)
+
+
+_PACKERS: dict[type, Callable[[bytes, Any, bool], bytes]] = {
+    int: _pack_int,
+    bool: _pack_int,
+    float: _pack_double,
+    str: _pack_str,
+    Tombstone: _pack_tombstone,
+}
+
+
+def pack_record(
+    encoded_key: bytes, value: U | Tombstone, is_tombstoned: bool = False
+) -> bytes:
+    """
+    Serializes an item into a record.
+    Record layout is key_length, key, tombstone, value_type, value_length(if str), value.
+    A tombstone record, for the TOMBSTONE value or is_tombstoned, ends after the tombstone bit.
+    The packer is looked up by the exact type of the value, the record is packed with a single
+    precompiled struct per value type and key length.
+    """
+    packer = _pack_tombstone if is_tombstoned else _PACKERS.get(type(value))
+    if packer is None:
+        raise (TypeError("Unsupported type for value"))
+    return packer(encoded_key, value, is_tombstoned)
+
+
+def _reserve(buffer: bytearray, size: int):
+    """
+    Grows the buffer to at least size bytes.
+    """
+    if size > len(buffer):
+        buffer.extend(bytes(size - len(buffer)))
+
+
+def _pack_number_into(
+    value_type: bytes,
+    buffer: bytearray,
+    offset: int,
+    encoded_key: bytes,
+    value: int | float,
+    is_tombstoned: bool,
+) -> int:
+    key_length = len(encoded_key)
+    record_struct = _record_struct(value_type, key_length)
+    record_end = offset + record_struct.size
+    _reserve(buffer, record_end)
+    record_struct.pack_into(
+        buffer, offset, key_length, encoded_key, is_tombstoned, value_type, value
+    )
+    return record_end
+
+
+def _pack_str_into(
+    buffer: bytearray, offset: int, encoded_key: bytes, value: str, is_tombstoned: bool
+) -> int:
+    key_length = len(encoded_key)
+    encoded_value = value.encode("utf-8")
+    record_struct = _record_struct(b"s", key_length)
+    value_start = offset + record_struct.size
+    record_end = value_start + len(encoded_value)
+    _reserve(buffer, record_end)
+    record_struct.pack_into(
+        buffer,
+        offset,
+        key_length,
+        encoded_key,
+        is_tombstoned,
+        b"s",
+        len(encoded_value),
+    )
+    buffer[value_start:record_end] = encoded_value
+    return record_end
+
+
+def _pack_tombstone_into(
+    buffer: bytearray, offset: int, encoded_key: bytes, value: Any, is_tombstoned: bool
+) -> int:
+    key_length = len(encoded_key)
+    record_struct = _tombstone_struct(key_length)
+    record_end = offset + record_struct.size
+    _reserve(buffer, record_end)
+    record_struct.pack_into(buffer, offset, key_length, encoded_key, True)
+    return record_end
+
+
+_PACKERS_INTO: dict[type, Callable[[bytearray, int, bytes, Any, bool], int]] = {
+    int: functools.partial(_pack_number_into, b"i"),
+    bool: functools.partial(_pack_number_into, b"i"),
+    float: functools.partial(_pack_number_into, b"d"),
+    str: _pack_str_into,
+    Tombstone: _pack_tombstone_into,
+}
+
+
+def pack_record_into(
+    buffer: bytearray,
+    offset: int,
+    encoded_key: bytes,
+    value: U | Tombstone,
+    is_tombstoned: bool = False,
+) -> int:
+    """
+    Serializes an item into buffer at offset, with the same layout as pack_record,
+    without allocating the record. The buffer grows if the record does not fit.
+    Returns the offset of the end of the record.
+    """
+    packer = _pack_tombstone_into if is_tombstoned else _PACKERS_INTO.get(type(value))
+    if packer is None:
+        raise (TypeError("Unsupported type for value"))
+    return packer(buffer, offset, encoded_key, value, is_tombstoned)
+
+
+def read_raw_record(data, offset: int) -> tuple[bytes, U | Tombstone, bool, int]:
+    """
+    Reads the encoded key, value and tombstone bit of the record starting at offset in data,
+    any bytes-like object, and returns them with the offset of the next record.
+    The value of a tombstone record is TOMBSTONE.
+    The record is read with a single unpack of the struct for its key length,
+    picked by peeking at the tombstone bit and value type as single bytes, without unpacking or slicing.
+    Raises IndexError if data ends before the value type.
+    """
+    key_length = _KEY_LENGTH.unpack_from(data, offset)[0]
+    key_end = offset + _KEY_LENGTH_SIZE + key_length
+    if data[key_end] == 1:
+        record_struct = _tombstone_struct(key_length)
+        encoded_key = record_struct.unpack_from(data, offset)[1]
+        return encoded_key, TOMBSTONE, True, offset + record_struct.size
+
+    value_type = _VALUE_TYPES.get(data[key_end + 1])
+    if value_type is None:
+        raise (TypeError("Unsupported type for value"))
+
+    record_struct = _record_struct(value_type, key_length)
+    _, encoded_key, is_tombstoned, _, value = record_struct.unpack_from(data, offset)
+    record_end = offset + record_struct.size
+    if value_type == b"s":
+        value_end = record_end + value
+        return (
+            encoded_key,
+            data[record_end:value_end].decode("utf-8"),
+            is_tombstoned,
+            value_end,
+        )
+    return encoded_key, value, is_tombstoned, record_end
+
+
+def read_record(data, offset: int) -> tuple[str, U | Tombstone, bool, int]:
+    """
+    Reads a record like read_raw_record, with the key decoded.
+    """
+    encoded_key, value, is_tombstoned, next_offset = read_raw_record(data, offset)
+    return encoded_key.decode("utf-8"), value, is_tombstoned, next_offset
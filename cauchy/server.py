@@ -1,8 +1,16 @@
+from __future__ import annotations
+
+import selectors
 import socket
 import sys
-import threading
+from typing import Iterator
 
 from .lsmtree import LSMTree
+from .protocol import HEADER, MAX_MESSAGE_SIZE
+
+RECEIVE_BUFFER_SIZE = 65536
+# a connection is not read from while more reply bytes than this are waiting to be sent
+MAX_PENDING_OUTPUT = 1 << 20
 
 
 class Node:
@@ -19,13 +27,16 @@ class Node:
         self.storage = LSMTree(storage_location)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.host = host
         self.port = port
+        self._selector = selectors.DefaultSelector()
+        self._connections: dict[socket.socket, Connection] = {}
 
     def start_server(self):
         """
         Starts the server and listens for multiple connections.
-        When a connection is established, a new thread is created to handle it.
+        All connections are served from a single thread by a selector based event loop.
         """
         print(f"Starting server on {self.host}:{self.port}")
 
@@ -36,78 +47,241 @@ class Node:
             sys.exit()
 
         self.server_socket.listen(5)
+        self.server_socket.setblocking(False)
+        self._selector.register(self.server_socket, selectors.EVENT_READ, self._accept)
         print("Waiting for a connection.")
 
         try:
             while True:
-                sock, address = self.server_socket.accept()
-                print(f"Connected to: {address[0]}:{address[1]}")
-                new_connection_thread = ConnectionThread(sock, self)
-                new_connection_thread.start()
+                for key, mask in self._selector.select(timeout=1):
+                    callback = key.data
+                    callback(key.fileobj, mask)
         except KeyboardInterrupt:
             print("Closing server")
+            for sock in list(self._connections):
+                self._close_connection(sock)
+            self._selector.close()
             self.server_socket.close()
+            self.storage.close()
             sys.exit()
 
-    def handle_message(self, client_socket: socket.socket, message: str):
+    def _accept(self, server_socket: socket.socket, mask: int):
+        """
+        Accepts a new connection and registers it with the selector.
+        """
+        try:
+            sock, address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        print(f"Connected to: {address[0]}:{address[1]}")
+        # disable Nagle's algorithm, responses are small and latency bound
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self._connections[sock] = Connection(sock)
+        self._selector.register(sock, selectors.EVENT_READ, self._on_ready)
+
+    def _on_ready(self, sock: socket.socket, mask: int):
+        """
+        Sends pending replies if the connection is writable, then handles the messages left in its buffer
+        and reads from it if it is readable, as long as its pending replies are within MAX_PENDING_OUTPUT.
+        """
+        connection = self._connections.get(sock)
+        if connection is None:
+            return
+        if mask & selectors.EVENT_WRITE:
+            if not self._send_pending(connection):
+                return
+            if connection.has_buffered_data and (
+                connection.pending_output <= MAX_PENDING_OUTPUT
+            ):
+                # messages left in the buffer while too many replies were pending
+                if not self._handle_messages(connection):
+                    return
+        if (
+            mask & selectors.EVENT_READ
+            and connection.pending_output <= MAX_PENDING_OUTPUT
+        ):
+            self._on_data(connection)
+
+    def _on_data(self, connection: Connection):
+        """
+        Reads the available bytes from a connection into its receive buffer and handles its messages.
+        """
+        try:
+            received = connection.receive()
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            received = 0
+
+        if not received:
+            print("Closing connection")
+            self._close_connection(connection.socket)
+            return
+        self._handle_messages(connection)
+
+    def _handle_messages(self, connection: Connection) -> bool:
+        """
+        Hands the complete messages in the receive buffer of a connection to handle_message and queues their replies,
+        a message that fails is answered with the error instead of stopping the event loop.
+        Messages are left in the buffer once more than MAX_PENDING_OUTPUT reply bytes are pending,
+        they are handled when the replies are sent, so a burst of pipelined messages cannot grow the replies unbounded.
+        Returns False if the connection was closed.
+        """
+        try:
+            for message in connection.messages(MAX_PENDING_OUTPUT):
+                try:
+                    reply = self.handle_message(connection.socket, message)
+                except Exception as e:
+                    print(f"Failed to handle message {message!r}: {e!r}")
+                    reply = f"Error: {e}".encode("utf-8")
+                connection.queue(reply)
+        except ValueError as e:
+            print(f"Closing connection: {e}")
+            self._close_connection(connection.socket)
+            return False
+        return self._send_pending(connection)
+
+    def _send_pending(self, connection: Connection) -> bool:
         """
-        Handles a message received from a client on a connection thread.
-        The message is parsed and the appropriate action is taken.
+        Sends as much of the pending replies as the socket accepts without blocking.
+        The connection is watched for writability while replies are pending, and is not read from
+        while more than MAX_PENDING_OUTPUT bytes are pending, so a slow reader cannot grow them unbounded.
+        Returns False if the connection was closed.
         """
-        print(f"Received message: {message} from {client_socket.getpeername()}")
+        try:
+            connection.send()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            print("Closing connection")
+            self._close_connection(connection.socket)
+            return False
+
+        events = selectors.EVENT_READ
+        if connection.pending_output:
+            events = selectors.EVENT_WRITE
+            if connection.pending_output <= MAX_PENDING_OUTPUT:
+                events |= selectors.EVENT_READ
+        if events != self._selector.get_key(connection.socket).events:
+            self._selector.modify(connection.socket, events, self._on_ready)
+        return True
+
+    def _close_connection(self, sock: socket.socket):
+        self._selector.unregister(sock)
+        self._connections.pop(sock, None)
+        sock.close()
 
-        if message.startswith("get"):
-            key = message.split(" ")[1]
+    def handle_message(self, client_socket: socket.socket, message: bytes) -> bytes:
+        """
+        Handles a message received from a client connection and returns the reply.
+        The message is parsed as raw bytes and the appropriate action is taken.
+        Only the key and value are decoded before they are handed to the storage.
+        """
+        print(f"Received message: {message!r} from {client_socket.getpeername()}")
+
+        command, _, arguments = message.partition(b" ")
+        if command == b"get":
+            key = arguments.decode("utf-8")
             value = self.storage.get(key)
             if value is None:
                 value = f"key '{key}' not found"
-            if isinstance(value, str):
-                client_socket.sendall(str(value).encode("utf-8"))
+            return str(value).encode("utf-8")
 
-        elif message.startswith("put"):
-            key, value = message.split(" ")[1:]
-            self.storage.put(key, value)
-            client_socket.sendall("OK".encode("utf-8"))
+        elif command == b"put":
+            key_bytes, _, value_bytes = arguments.partition(b" ")
+            self.storage.put(key_bytes.decode("utf-8"), value_bytes.decode("utf-8"))
+            return b"OK"
 
-        elif message.startswith("delete"):
-            key = message.split(" ")[1]
-            self.storage.delete(key)
-            client_socket.sendall("OK".encode("utf-8"))
+        elif command == b"delete":
+            self.storage.delete(arguments.decode("utf-8"))
+            return b"OK"
 
         else:
-            client_socket.sendall(
-                'Unrecognized command. Type "exit" to exit'.encode("utf-8")
-            )
+            return b'Unrecognized command. Type "exit" to exit'
 
 
-class ConnectionThread(threading.Thread):
+class Connection:
     """
-    A thread that handles a connection to a client.
+    A client connection, its receive buffer and the replies waiting to be sent.
+    Messages are length-prefixed, the buffer is allocated once and reused across receives.
     """
 
-    def __init__(self, sock: socket.socket, node: Node):
-        threading.Thread.__init__(self)
-        self.node = node
+    def __init__(self, sock: socket.socket):
         self.socket = sock
-        self.socket.settimeout(3600)
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._used = 0
+        self._output = bytearray()
+        self._output_sent = 0
+
+    @property
+    def pending_output(self) -> int:
+        return len(self._output) - self._output_sent
 
-    def run(self):
+    @property
+    def has_buffered_data(self) -> bool:
+        return self._used > 0
+
+    def queue(self, reply: bytes):
         """
-        The main loop of the thread.
-        Waits for messages from the client and hands them to the server node to process them.
+        Queues a reply to be sent, prefixed by its length like the client messages.
         """
-        while True:
-            try:
-                message = self.socket.recv(1024)
-            except socket.timeout:
-                print("Connection timed out")
-                break
+        self._output += HEADER.pack(len(reply))
+        self._output += reply
 
-            decoded_message = message.decode("utf-8")
-            if message == "exit":
-                print("Closing connection")
+    def send(self):
+        """
+        Sends the pending replies until they are all sent or the socket would block.
+        The sent bytes are tracked by offset and dropped from the output buffer once the socket would block,
+        so the buffer only holds the pending replies and a pipelining client cannot grow it unbounded.
+        """
+        try:
+            with memoryview(self._output) as output:
+                while self._output_sent < len(output):
+                    self._output_sent += self.socket.send(output[self._output_sent :])
+        finally:
+            del self._output[: self._output_sent]
+            self._output_sent = 0
+
+    def receive(self) -> int:
+        """
+        Receives the available bytes into the free part of the buffer and returns how many were read.
+        """
+        received = self.socket.recv_into(self._view[self._used :])
+        self._used += received
+        return received
+
+    def messages(self, max_pending_output: int | None = None) -> Iterator[bytes]:
+        """
+        Yields the complete messages in the buffer, or only until more than max_pending_output reply bytes
+        are pending, the remaining messages are kept in the buffer.
+        A trailing partial message is moved to the start of the buffer, which grows if the message does not fit.
+        Raises ValueError if a message is announced larger than MAX_MESSAGE_SIZE.
+        """
+        start = 0
+        while self._used - start >= HEADER.size and (
+            max_pending_output is None or self.pending_output <= max_pending_output
+        ):
+            message_length = HEADER.unpack_from(self._buffer, start)[0]
+            if message_length > MAX_MESSAGE_SIZE:
+                raise ValueError(f"message of {message_length} bytes is too large")
+            end = start + HEADER.size + message_length
+            if end > self._used:
                 break
+            yield bytes(self._view[start + HEADER.size : end])
+            start = end
 
-            self.node.handle_message(self.socket, decoded_message)
+        remaining = self._used - start
+        if start:
+            self._buffer[:remaining] = self._buffer[start : self._used]
+            self._used = remaining
+        if remaining >= HEADER.size:
+            frame_length = HEADER.size + HEADER.unpack_from(self._buffer)[0]
+            if frame_length > len(self._buffer):
+                self._grow(frame_length)
 
-        self.socket.close()
+    def _grow(self, size: int):
+        self._view.release()
+        self._buffer.extend(bytes(size - len(self._buffer)))
+        self._view = memoryview(self._buffer)
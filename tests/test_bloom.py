@@ -0,0 +1,60 @@
+from cauchy.bloom import BloomFilter, BloomFilterCache, CachedBloomFilter, key_hashes
+
+
+def test_added_keys_are_contained():
+    bloom = BloomFilter(100)
+    for i in range(100):
+        bloom.add(str(i).encode())
+    assert all(str(i).encode() in bloom for i in range(100))
+
+
+def test_false_positive_rate():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(f"key_{i}".encode())
+    false_positives = sum(f"other_{i}".encode() in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_serialization_roundtrip():
+    bloom = BloomFilter(100)
+    for i in range(100):
+        bloom.add(str(i).encode())
+    restored = BloomFilter.from_bytes(bloom.to_bytes())
+    assert restored.capacity == 100
+    assert all(str(i).encode() in restored for i in range(100))
+    assert restored.to_bytes() == bloom.to_bytes()
+
+
+def test_hashes_are_shared_across_filters():
+    blooms = [BloomFilter(capacity) for capacity in (1, 50, 1000)]
+    for bloom in blooms:
+        for i in range(50):
+            bloom.add(f"key_{i}".encode())
+    for key in (f"key_{i}".encode() for i in range(100)):
+        hashes = key_hashes(key)
+        assert all(bloom.might_contain(hashes) == (key in bloom) for bloom in blooms)
+
+
+def test_bloom_filter_cache_evicts_by_size(tmp_path):
+    paths = []
+    for i in range(3):
+        bloom = BloomFilter(100)
+        bloom.add(f"key_{i}".encode())
+        path = str(tmp_path / f"{i}.bf")
+        with open(path, "wb") as f:
+            f.write(bloom.to_bytes())
+        paths.append(path)
+    cache = BloomFilterCache(2 * BloomFilter(100).size_in_bytes)
+    filters = [CachedBloomFilter(path, 100, cache) for path in paths]
+    assert all(f"key_{i}".encode() in filters[i] for i in range(3))
+    # the filter of the first path was the least recently used one
+    assert cache.size_in_bytes == 2 * BloomFilter(100).size_in_bytes
+    assert list(cache._filters) == paths[1:]
+    assert b"key_0" in filters[0]
+    assert list(cache._filters) == [paths[2], paths[0]]
+
+    cache.discard(paths[2])
+    assert list(cache._filters) == [paths[0]]
+    # a filter whose file is gone rules out no key
+    assert b"other" in CachedBloomFilter(str(tmp_path / "missing.bf"), 1, cache)
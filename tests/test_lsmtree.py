@@ -1,22 +1,32 @@
+import array
 import os
 import shutil
+import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
 
-from cauchy.lsmtree import LSMTree
+from cauchy import lsmtree
+from cauchy.lsmtree import LSMTree, Segment
 
 
 @pytest.fixture
-def tree():
+def storage():
     # Setup
     if os.path.exists("storage"):
         shutil.rmtree("storage")
-    tree = LSMTree(storage_location="storage/")
+    yield "storage/"
+
+
+@pytest.fixture
+def tree(storage):
+    tree = LSMTree(storage_location=storage)
     yield tree
     # Teardown
-    tree._stop_merge_scheduler()
+    tree.close()
 
 
 def test_put_and_get(tree):
@@ -32,29 +42,281 @@ def test_memtable_overflow(tree):
     tree.put("test_key2", large_value2)
     assert tree.get("test_key") == large_value
     assert (
-        tree._memtable.get("test_key") is None
+        tree._memtables[0].get("test_key") is None
     )  # The data should have been flushed to disk
 
 
+def test_get_batch(tree):
+    for i in range(500):
+        tree.put(f"key_{i:03}", i)
+    tree._flush_memtable()
+    for i in range(0, 500, 2):
+        tree.put(f"key_{i:03}", f"updated_{i}")
+    tree.delete("key_001")
+    tree._flush_memtable()
+    tree.put("key_003", "in memtable")
+    tree.delete("key_005")
+
+    keys = [f"key_{i:03}" for i in range(500)] + ["missing", "key_002", ""]
+    assert tree.get_batch(keys) == [tree.get(key) for key in keys]
+    assert tree.get_batch([]) == []
+
+    tree._load_block.cache_clear()
+    tree.get_batch([f"key_{i:03}" for i in range(1, 500, 2)])
+    # every block holding the keys is loaded once
+    assert tree._load_block.cache_info().hits == 0
+    assert tree._load_block.cache_info().misses <= len(
+        tree._data_segments[0].block_starts
+    ) + len(tree._data_segments[1].block_starts)
+
+
+def test_prefetch_skips_cached_blocks(tree):
+    for i in range(500):
+        tree.put(f"key_{i:03}", "x" * 100)
+    tree._flush_memtable()
+    segment = tree._data_segments[0]
+    starts = list(segment.block_starts) + [segment.size]
+    block_ranges = list(zip(starts, starts[1:]))[:4]
+    assert len(block_ranges) == 4
+    # contiguous blocks are prefetched as one range
+    assert tree._uncached_ranges(segment.data, block_ranges) == [
+        (block_ranges[0][0], block_ranges[3][1])
+    ]
+    tree._load_segment_block(segment, block_ranges[1])
+    assert tree._uncached_ranges(segment.data, block_ranges) == [
+        block_ranges[0],
+        (block_ranges[2][0], block_ranges[3][1]),
+    ]
+
+
+def test_parallel_segment_reads(storage):
+    tree = LSMTree(storage_location=storage, read_threads=4)
+    try:
+        for i in range(3):
+            for j in range(50):
+                tree.put(f"key_{j}", f"value_{i}_{j}")
+            tree.put(f"only_in_{i}", i)
+            tree._flush_memtable()
+        tree.delete("key_0")
+        tree._flush_memtable()
+        assert len(tree._data_segments) == 4
+        assert tree.get("key_0") is None
+        assert all(tree.get(f"key_{j}") == f"value_2_{j}" for j in range(1, 50))
+        assert [tree.get(f"only_in_{i}") for i in range(3)] == [0, 1, 2]
+        assert tree.get("missing") is None
+    finally:
+        tree.close()
+
+
+def test_negative_read_threads(storage):
+    with pytest.raises(ValueError):
+        LSMTree(storage_location=storage, read_threads=-1)
+
+
+def test_flush_syncs_directory_once(storage):
+    tree = LSMTree(storage_location=storage, memtable_shards=4)
+    try:
+        for i in range(100):
+            tree.put(f"key_{i}", i)
+        with mock.patch.object(
+            tree, "_sync_directory", wraps=tree._sync_directory
+        ) as sync_directory:
+            tree._flush_memtable()
+        assert len(tree._data_segments) == 4
+        # once for the new write-ahead log and once for all the segments of the flush
+        assert sync_directory.call_count == 2
+    finally:
+        tree.close()
+
+
+def test_put_does_not_wait_for_flush(tree):
+    tree._memtable_max_size = 10
+    flush_started = threading.Event()
+    release_flush = threading.Event()
+    serialize_memtable_shard = tree._serialize_memtable_shard
+
+    def blocked_serialize(*args):
+        flush_started.set()
+        release_flush.wait()
+        return serialize_memtable_shard(*args)
+
+    with mock.patch.object(
+        tree, "_serialize_memtable_shard", side_effect=blocked_serialize
+    ):
+        tree.put("key", "a value larger than the memtable")
+        assert flush_started.wait(5)
+        # the flush is still running, the key is served from the memtable being flushed
+        assert tree.get("key") == "a value larger than the memtable"
+        assert tree._data_segments == []
+        release_flush.set()
+        tree._flush_memtable()
+    assert len(tree._data_segments) == 1
+    assert tree.get("key") == "a value larger than the memtable"
+
+
+def test_flushed_memtable_is_read_from_memory_until_written(tree):
+    write_started = threading.Event()
+    release_write = threading.Event()
+    write_in_memory_segment = tree._write_in_memory_segment
+
+    def blocked_serialize(segment):
+        write_started.set()
+        release_write.wait()
+        return write_in_memory_segment(segment)
+
+    for i in range(100):
+        tree.put(f"key_{i}", i)
+    with mock.patch.object(
+        tree, "_write_in_memory_segment", side_effect=blocked_serialize
+    ):
+        flush = tree._start_flush(compact=False)
+        assert write_started.wait(5)
+        # the memtable is released, the serialized segment serves reads before it is on disk
+        assert tree._memtables_being_flushed == [{}]
+        (segment,) = tree._data_segments
+        assert segment.in_memory
+        assert not os.path.exists(segment.name)
+        assert all(tree.get(f"key_{i}") == i for i in range(100))
+        assert tree.get_batch(["key_1", "missing"]) == [1, None]
+        release_write.set()
+        flush.result()
+    (segment,) = tree._data_segments
+    assert not segment.in_memory
+    assert os.path.getsize(segment.name) == segment.size
+    assert all(tree.get(f"key_{i}") == i for i in range(100))
+
+
+def test_keys_are_interned(tree):
+    tree.put("".join(["interned", "_key"]), 1)
+    tree.put("".join(["interned", "_key"]), 2)
+    (key,) = tree._memtables[0]
+    assert key is sys.intern("interned_key")
+
+
+def test_short_values_are_deduplicated(tree):
+    tree.put("a", "".join(["short", "_value"]))
+    tree.put("b", "".join(["short", "_value"]))
+    assert tree._memtables[0]["a"] is tree._memtables[0]["b"]
+    tree.put("c", "".join(["x" * 100, "long_value"]))
+    tree.put("d", "".join(["x" * 100, "long_value"]))
+    assert tree._memtables[0]["c"] is not tree._memtables[0]["d"]
+    tree._flush_memtable()
+    assert tree._memtable_values == {}
+
+
+def test_deduplicated_values_are_bounded(tree):
+    with mock.patch("cauchy.lsmtree._MAX_INTERNED_VALUES", 2):
+        for i in range(4):
+            tree.put(f"key_{i}", f"value_{i}")
+        tree.put("key_4", "".join(["value", "_1"]))
+        tree.put("key_5", "".join(["value", "_3"]))
+    assert list(tree._memtable_values) == ["value_0", "value_1"]
+    assert tree._memtables[0]["key_4"] is tree._memtables[0]["key_1"]
+    assert tree._memtables[0]["key_5"] is not tree._memtables[0]["key_3"]
+
+
+def test_memtable_size_tracking(tree):
+    tree.put("test_key", "test_value")
+    size = tree._memtable_bytes
+    tree.put("test_key", "other_value")
+    tree.put("test_key", "test_value")
+    assert tree._memtable_bytes == size
+    tree.put("number", 10**9)
+    tree.put("float", 0.1)
+    assert tree._memtable_bytes == size + len("number") + len("float") + 2 * 48 + 4 + 8
+    # non-ascii values are measured by their utf-8 length
+    previous_size = tree._memtable_bytes
+    tree.put("test_key", "välue")
+    assert tree._memtable_bytes == previous_size - len("test_value") + 6
+    tree._flush_memtable()
+    assert tree._memtable_bytes == 0
+
+
 def test_read_from_disk(tree):
     tree.put("test_key", "test_value")
     tree._flush_memtable()
     assert tree.get("test_key") == "test_value"
 
 
-def test_find_block_range_for_key(tree):
-    mock_block_offsets = {"a": 0, "c": 3, "d": 5}
-    assert tree._find_block_range_for_key("b", mock_block_offsets) == ("a", "c")
-    assert tree._find_block_range_for_key("z", mock_block_offsets) == ("d", None)
+def test_read_across_blocks(tree):
+    for i in range(500):
+        tree.put(f"key_{i:03}", f"value_{i}")
+    tree._flush_memtable()
+    segment = tree._data_segments[0]
+    assert len(segment.block_starts) > 1
+    assert len(segment.block_keys) == len(segment.block_starts)
+    assert segment.block_keys == sorted(segment.block_keys)
+    assert segment.block_starts.typecode == "Q"
+    assert segment.block_starts[0] == 0
+    assert list(segment.block_starts) == sorted(segment.block_starts)
+    assert segment.block_keys[0] == b"key_000" and segment.max_key == b"key_499"
+    assert all(tree.get(f"key_{i:03}") == f"value_{i}" for i in range(500))
+    assert tree.get("key_5000") is None
+    assert tree._load_block.cache_info().hits > 0
+
+
+def test_read_non_ascii_keys_across_blocks(tree):
+    keys = [f"{prefix}_{i}" for prefix in ("a", "é", "z", "日本") for i in range(200)]
+    for key in keys:
+        tree.put(key, key.upper())
+    tree._flush_memtable()
+    assert len(tree._data_segments[0].block_starts) > 1
+    assert all(tree.get(key) == key.upper() for key in keys)
+
+
+def test_sharded_memtable(storage):
+    tree = LSMTree(storage_location=storage, memtable_shards=4)
+    for i in range(100):
+        tree.put(str(i), i)
+    tree._flush_memtable()
+    assert len(tree._data_segments) == 4
+    assert {segment.shard for segment in tree._data_segments} == {0, 1, 2, 3}
+    assert all(tree.get(str(i)) == i for i in range(100))
+    tree._merge_and_compact()
+    assert tree._data_segments[0].shard is None
+    assert all(tree.get(str(i)) == i for i in range(100))
+    tree.close()
+
+
+def test_falsy_values_shadow_older_values(tree):
+    tree.put("k", 5)
+    tree._flush_memtable()
+    tree.put("k", 0)
+    assert tree.get("k") == 0
+    tree.put("s", "old")
+    tree._flush_memtable()
+    tree.put("s", "")
+    assert tree.get("s") == ""
+
+
+def test_memtable_shards_must_be_positive(storage):
+    with pytest.raises(ValueError):
+        LSMTree(storage_location=storage, memtable_shards=0)
+
+
+def test_find_block_for_key(tree):
+    block_starts = array.array("Q", [0, 10, 25])
+    segment = Segment("segment", [b"a", b"c", b"d"], block_starts, b"e", None, None, 40)
+    assert tree._find_block_for_key(b"b", segment) == (0, 10)
+    assert tree._find_block_for_key(b"c", segment) == (10, 25)
+    assert tree._find_block_for_key(b"z", segment) == (25, 40)
+    assert tree._find_block_for_key(b"0", segment) is None
+    keys = [b"0", b"a", b"b", b"c", b"c", b"cc", b"d", b"z"]
+    assert list(tree._find_blocks_for_keys(keys, segment)) == [
+        (key, tree._find_block_for_key(key, segment)) for key in keys[1:]
+    ]
 
 
 def test_find_key_in_segment(tree):
-    tree._memtable = {"a": "1", "b": 2, "c": 3.2}
+    tree._memtables = [{"a": "1", "b": 2, "c": 3.2}]
     tree._flush_memtable()
     assert tree._find_item_in_segment("a", tree._data_segments[0])[0] == "1"
     assert tree._find_item_in_segment("b", tree._data_segments[0])[0] == 2
     assert tree._find_item_in_segment("c", tree._data_segments[0])[0] == 3.2
+    misses = tree._load_block.cache_info().misses
     assert tree._find_item_in_segment("z", tree._data_segments[0]) is None
+    # the bloom filter rules the key out, no block is loaded
+    assert tree._load_block.cache_info().misses == misses
 
 
 def test_delete(tree):
@@ -70,6 +332,24 @@ def test_delete(tree):
     assert tree.get("c") == 3.2
 
 
+def test_deleted_key_is_not_read_from_older_segments(tree):
+    tree.put("d", "v")
+    tree._flush_memtable()
+    tree.delete("d")
+    tree._flush_memtable()
+    assert tree.get("d") is None
+    tree.put("d", "w")
+    tree._flush_memtable()
+    assert tree.get("d") == "w"
+
+
+def test_tombstone_string_is_a_value(tree):
+    tree.put("a", "tombstone")
+    assert tree.get("a") == "tombstone"
+    tree._flush_memtable()
+    assert tree.get("a") == "tombstone"
+
+
 def test_merge_and_compact(tree):
     total_segment_size = 0
     for i in range(10):
@@ -83,6 +363,245 @@ def test_merge_and_compact(tree):
     assert tree.get("0") == "value"
 
 
+def test_segment_ranges_follow_segments(tree):
+    for key in ("b", "a", "c"):
+        tree.put(key, "value")
+        tree._flush_memtable()
+    segments, first_keys, max_keys = tree._segment_ranges
+    assert segments == tree._data_segments
+    assert first_keys == max_keys == [b"b", b"a", b"c"]
+    tree._merge_and_compact()
+    assert tree._segment_ranges.first_keys == [b"a"]
+    assert tree._segment_ranges.max_keys == [b"c"]
+    assert tree.get("b") == "value"
+    assert tree.get("d") is None
+
+
+def test_bloom_cache_size(storage):
+    tree = LSMTree(storage_location=storage, bloom_cache_size=1)
+    for i in range(5):
+        tree.put(f"key_{i}", str(i))
+        tree._flush_memtable()
+    # the filters are cached as their segments are written
+    assert len(tree._bloom_cache._filters) == 5
+    assert all(tree.get(f"key_{i}") == str(i) for i in range(5))
+    assert tree.get("other") is None
+    tree._merge_and_compact()
+    assert [os.path.basename(path) for path in tree._bloom_cache._filters] == [
+        "merged_segment_1.bf"
+    ]
+    assert all(tree.get(f"key_{i}") == str(i) for i in range(5))
+    tree.close()
+
+
+def test_iter_segment_restores_random_reads(tree):
+    for i in range(10):
+        tree.put(f"key_{i}", i)
+    tree._flush_memtable()
+    segment = tree._data_segments[0]
+    with mock.patch("cauchy.lsmtree._advise", wraps=lsmtree._advise) as advise:
+        items = tree._iter_segment(segment, 0)
+        assert next(items) == (b"key_0", 0, 0)
+        advise.assert_called_once_with(segment.data, lsmtree._MADV_SEQUENTIAL)
+        # a merge that stops early leaves the segment advised for point lookups
+        items.close()
+        advise.assert_called_with(segment.data, lsmtree._MADV_RANDOM)
+    assert tree.get("key_5") == 5
+
+
+def test_merge_drops_deleted_keys(tree):
+    tree.put("a", "1")
+    tree.put("b", 2)
+    tree._flush_memtable()
+    tree.delete("a")
+    tree._flush_memtable()
+    tree._merge_and_compact()
+    assert len(tree._data_segments) == 1
+    assert tree.get("a") is None
+    assert tree.get("b") == 2
+
+
+def test_merge_key_ranges_in_processes(storage):
+    tree = LSMTree(
+        storage_location=storage, sstable_block_size=1, compaction_processes=3
+    )
+    try:
+        for i in range(3):
+            for j in range(i, 600, 2):
+                tree.put(f"key_{j:03}", f"value_{i}_{j}")
+            tree.delete(f"key_{i:03}")
+            tree._flush_memtable()
+        tree._merge_and_compact()
+        segments = tree._data_segments
+        assert len(segments) == 3
+        assert all(
+            segment.name.split("/")[-1].startswith("merged") for segment in segments
+        )
+        # the key ranges of the merged segments do not overlap
+        ranges = sorted(
+            (segment.block_keys[0], segment.max_key) for segment in segments
+        )
+        assert all(high < low for (_, high), (low, _) in zip(ranges, ranges[1:]))
+        # even keys were last written by the third flush, odd keys by the second
+        expected = {
+            f"key_{j:03}": f"value_{1 if j % 2 else 2}_{j}" for j in range(3, 600)
+        }
+        expected.update({"key_000": None, "key_001": None, "key_002": None})
+        assert all(tree.get(key) == value for key, value in expected.items())
+    finally:
+        tree.close()
+    reopened_tree = LSMTree(storage_location=storage)
+    try:
+        assert len(reopened_tree._data_segments) == 3
+        assert all(reopened_tree.get(key) == value for key, value in expected.items())
+    finally:
+        reopened_tree.close()
+
+
+def test_failed_key_range_removes_merged_segments(storage):
+    tree = LSMTree(
+        storage_location=storage, sstable_block_size=1, compaction_processes=3
+    )
+    # the ranges are merged in threads, so the merge of a range can be patched
+    tree._compaction_pool = ThreadPoolExecutor(max_workers=3)
+    merge_segment_range = lsmtree._merge_segment_range
+
+    def failing_merge(name, sources, low, high, *args):
+        if high is None:
+            raise OSError("disk full")
+        return merge_segment_range(name, sources, low, high, *args)
+
+    try:
+        for i in range(3):
+            for j in range(i, 600, 2):
+                tree.put(f"key_{j:03}", f"value_{i}_{j}")
+            tree._flush_memtable()
+        segments = tree._data_segments
+        with mock.patch("cauchy.lsmtree._merge_segment_range", failing_merge):
+            with pytest.raises(OSError):
+                tree._merge_and_compact()
+        assert tree._data_segments == segments
+        assert not [name for name in os.listdir(storage) if "merged" in name]
+        assert tree.get("key_599") == "value_1_599"
+    finally:
+        tree.close()
+
+
+def test_negative_compaction_processes(storage):
+    with pytest.raises(ValueError):
+        LSMTree(storage_location=storage, compaction_processes=-1)
+
+
+def test_compaction_does_not_cache_removed_segments(tree):
+    tree.put("a", "1")
+    tree._flush_memtable()
+    tree.put("b", "2")
+    tree._flush_memtable()
+    generation = tree._segments_generation
+    old_segment = tree._data_segments[0]
+    tree._merge_and_compact()
+    # a get that read the segments before the compaction still finds the key, without caching the block
+    assert tree._find_record_in_segment(b"a", old_segment, generation)[0] == "1"
+    assert tree._load_block.cache_info().currsize == 0
+    assert tree.get("a") == "1"
+    assert tree._load_block.cache_info().currsize == 1
+
+
+def test_background_compaction(tree):
+    tree._memtable_max_size = 200
+    tree._compaction_threshold = 2
+    for i in range(100):
+        tree.put(f"key_{i % 30}", i)
+    deadline = time.monotonic() + 5
+    while "merged_segment" not in tree._data_segments[0].name:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert all(tree.get(f"key_{i}") == 90 + i for i in range(10))
+    assert all(tree.get(f"key_{i}") == 60 + i for i in range(10, 30))
+
+
+def test_failed_compaction_does_not_stop_the_scheduler(tree):
+    tree._compaction_threshold = 1
+    for key in ("a", "b"):
+        tree.put(key, "value")
+        tree._flush_memtable()
+    merge_and_compact = tree._merge_and_compact
+    with mock.patch.object(
+        tree, "_merge_and_compact", side_effect=[OSError("disk full"), None]
+    ) as failing_merge:
+        tree._request_compaction()
+        deadline = time.monotonic() + 5
+        while failing_merge.call_count < 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        tree._request_compaction()
+        while failing_merge.call_count < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    assert tree._merge_scheduler.is_alive()
+    merge_and_compact()
+    assert len(tree._data_segments) == 1
+
+
+def test_wal_replay(tree):
+    tree.put("a", "1")
+    tree.put("b", 2)
+    tree.delete("a")
+    tree._flush_memtable()
+    tree.put("c", 3.2)
+    tree.delete("b")
+    tree.close()
+    recovered_tree = LSMTree(storage_location="storage/")
+    try:
+        assert recovered_tree.get("c") == 3.2
+        assert recovered_tree.get("b") is None
+        assert recovered_tree.get("a") is None
+        recovered_tree._flush_memtable()
+        # wal_2 was replayed, flushing it deletes wal_2 and the empty wal_3
+        assert sorted(os.listdir("storage")) == [
+            "segment_1",
+            "segment_1.bf",
+            "segment_2",
+            "segment_2.bf",
+            "wal_4.log",
+        ]
+        assert recovered_tree.get("c") == 3.2
+        assert recovered_tree.get("b") is None
+    finally:
+        recovered_tree.close()
+
+
+def test_reopen_loads_segments(tree):
+    for i in range(500):
+        tree.put(f"key_{i:03}", f"value_{i}")
+    tree._flush_memtable()
+    tree.put("key_000", "updated")
+    tree._flush_memtable()
+    tree.close()
+    reopened_tree = LSMTree(storage_location="storage/")
+    try:
+        assert len(reopened_tree._data_segments) == 2
+        assert reopened_tree._data_segments[0].block_keys == (
+            tree._data_segments[0].block_keys
+        )
+        assert reopened_tree._data_segments[0].block_starts == (
+            tree._data_segments[0].block_starts
+        )
+        assert reopened_tree._data_segments[0].max_key == b"key_499"
+        assert reopened_tree.get("key_000") == "updated"
+        assert reopened_tree._data_segments[0].bloom.to_bytes() == (
+            tree._data_segments[0].bloom.to_bytes()
+        )
+        assert all(
+            reopened_tree.get(f"key_{i:03}") == f"value_{i}" for i in range(1, 500)
+        )
+        reopened_tree.put("key_001", "new")
+        reopened_tree._flush_memtable()
+        assert reopened_tree._data_segments[-1].name.endswith("segment_3")
+    finally:
+        reopened_tree.close()
+
+
 def test_merge_is_called():
     mock_merge = mock.Mock()
     with mock.patch.object(LSMTree, "_merge_and_compact", new=mock_merge):
@@ -93,7 +612,28 @@ def test_merge_is_called():
         tree._flush_memtable()
         threading.Event().wait(0.02)
         assert mock_merge.call_count > 0
-        tree._stop_merge_scheduler()
+        tree.close()
+
+
+def test_flush_requests_compaction(storage):
+    mock_merge = mock.Mock()
+    with mock.patch.object(LSMTree, "_merge_and_compact", new=mock_merge):
+        tree = LSMTree(storage_location=storage, compaction_threshold=1)
+        try:
+            tree._memtable_max_size = 10
+            tree.put("a", "a value larger than the memtable")
+            tree._flush_memtable()
+            threading.Event().wait(0.02)
+            mock_merge.assert_not_called()
+            # the second segment crosses the threshold, the scheduler does not wait for the hour to pass
+            tree.put("b", "a value larger than the memtable")
+            tree._flush_memtable()
+            deadline = time.monotonic() + 5
+            while not mock_merge.called:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        finally:
+            tree.close()
 
 
 def test_update_order(tree):
@@ -0,0 +1,53 @@
+import pytest
+
+from cauchy.records import TOMBSTONE, pack_record, pack_record_into, read_record
+
+
+def test_pack_and_read_record():
+    data = (
+        pack_record(b"a", "value")
+        + pack_record(b"b", 2)
+        + pack_record(b"c", 3.2)
+        + pack_record(b"d", "tombstone", True)
+    )
+    key, value, is_tombstoned, offset = read_record(data, 0)
+    assert (key, value, is_tombstoned) == ("a", "value", False)
+    key, value, is_tombstoned, offset = read_record(data, offset)
+    assert (key, value, is_tombstoned) == ("b", 2, False)
+    key, value, is_tombstoned, offset = read_record(data, offset)
+    assert (key, value, is_tombstoned) == ("c", 3.2, False)
+    key, value, is_tombstoned, offset = read_record(data, offset)
+    assert (key, is_tombstoned) == ("d", True)
+    assert offset == len(data)
+
+
+def test_pack_record_into_matches_pack_record():
+    items = [(b"a", "value"), (b"b", 2), (b"c", 3.2), (b"d", TOMBSTONE)]
+    buffer = bytearray(8)
+    offset = 0
+    for item in items:
+        offset = pack_record_into(buffer, offset, *item)
+    assert buffer[:offset] == b"".join(pack_record(*item) for item in items)
+
+
+def test_tombstone_record_has_no_value():
+    record = pack_record(b"key", TOMBSTONE)
+    assert len(record) == 4 + len(b"key") + 1
+    assert read_record(record, 0) == ("key", TOMBSTONE, True, len(record))
+
+
+def test_read_record_from_bytearray():
+    data = (
+        pack_record(b"a", 1) + pack_record(b"b", "two") + pack_record(b"c", TOMBSTONE)
+    )
+    buffer = bytearray(data)
+    key, value, _, offset = read_record(buffer, 0)
+    assert (key, value) == ("a", 1)
+    key, value, _, offset = read_record(buffer, offset)
+    assert (key, value) == ("b", "two")
+    key, value, _, offset = read_record(buffer, offset)
+    assert (key, value) == ("c", TOMBSTONE)
+    with pytest.raises(TypeError):
+        read_record(pack_record(b"a", 1).replace(b"i", b"x"), 0)
+    with pytest.raises(IndexError):
+        read_record(pack_record(b"a", 1)[:6], 0)
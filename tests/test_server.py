@@ -0,0 +1,158 @@
+import os
+import selectors
+import shutil
+import socket
+
+import pytest
+
+from cauchy.protocol import HEADER, MAX_MESSAGE_SIZE, encode_message, recv_message
+from cauchy.server import MAX_PENDING_OUTPUT, Connection, Node
+
+
+@pytest.fixture
+def node():
+    # Setup
+    if os.path.exists("storage"):
+        shutil.rmtree("storage")
+    node = Node(storage_location="storage/", port=0)
+    yield node
+    # Teardown
+    for sock in list(node._connections):
+        node._close_connection(sock)
+    node._selector.close()
+    node.server_socket.close()
+    node.storage.close()
+
+
+@pytest.fixture
+def connection(node):
+    server_end, client_end = socket.socketpair()
+    server_end.setblocking(False)
+    node._connections[server_end] = Connection(server_end)
+    node._selector.register(server_end, selectors.EVENT_READ, node._on_ready)
+    yield server_end, client_end
+    client_end.close()
+
+
+def test_failing_message_does_not_stop_serving(node, connection):
+    server_end, client_end = connection
+    client_end.sendall(encode_message(b"get \xff\xfe") + encode_message(b"put k v"))
+    node._on_ready(server_end, selectors.EVENT_READ)
+    assert recv_message(client_end).startswith(b"Error")
+    assert recv_message(client_end) == b"OK"
+    assert server_end in node._connections
+
+
+def test_large_reply_to_slow_reader(node, connection):
+    server_end, client_end = connection
+    value = "x" * (8 << 20)
+    node.storage.put("big", value)
+    client_end.sendall(encode_message(b"get big"))
+    node._on_ready(server_end, selectors.EVENT_READ)
+    pending = node._connections[server_end].pending_output
+    assert 0 < pending
+    # the reply does not fit in the socket buffer, the connection waits to be writable and is not read
+    assert node._selector.get_key(server_end).events == selectors.EVENT_WRITE
+
+    received = bytearray()
+    while len(received) < HEADER.size + len(value):
+        received += client_end.recv(1 << 16)
+        node._on_ready(server_end, selectors.EVENT_WRITE)
+    assert received == encode_message(value.encode())
+    assert node._connections[server_end].pending_output == 0
+    assert node._selector.get_key(server_end).events == selectors.EVENT_READ
+
+
+def test_pipelined_requests_to_slow_reader(node, connection):
+    server_end, client_end = connection
+    node.storage.put("big", "x" * (1 << 16))
+    output = node._connections[server_end]._output
+    received = 0
+    for _ in range(200):
+        client_end.sendall(encode_message(b"get big"))
+        for key, mask in node._selector.select(timeout=0):
+            key.data(key.fileobj, mask)
+        # the client reads less than it asks for
+        received += len(client_end.recv(1 << 15))
+        # the sent replies are dropped, the buffer only holds the pending ones
+        assert len(output) == node._connections[server_end].pending_output
+        # requests are left in the receive buffer once too many reply bytes are pending
+        assert len(output) <= MAX_PENDING_OUTPUT + HEADER.size + (1 << 16)
+    # the requests left in the buffer are answered once the client reads the replies
+    client_end.setblocking(False)
+    while node._connections[server_end].has_buffered_data or len(output):
+        for key, mask in node._selector.select(timeout=0):
+            key.data(key.fileobj, mask)
+        try:
+            received += len(client_end.recv(1 << 20))
+        except BlockingIOError:
+            pass
+    client_end.setblocking(True)
+    assert received == 200 * (HEADER.size + (1 << 16))
+
+
+def test_replies_are_framed(node, connection):
+    server_end, client_end = connection
+    client_end.sendall(encode_message(b"put a hello world") + encode_message(b"get a"))
+    node._on_ready(server_end, selectors.EVENT_READ)
+    assert recv_message(client_end) == b"OK"
+    assert recv_message(client_end) == b"hello world"
+
+
+def test_handle_message_parses_bytes(node, connection):
+    server_end, _ = connection
+    assert (
+        node.handle_message(server_end, "put clé välue with spaces".encode()) == b"OK"
+    )
+    assert (
+        node.handle_message(server_end, "get clé".encode())
+        == "välue with spaces".encode()
+    )
+    assert node.handle_message(server_end, b"delete cl\xc3\xa9") == b"OK"
+    assert (
+        node.handle_message(server_end, "get clé".encode())
+        == "key 'clé' not found".encode()
+    )
+    assert node.handle_message(server_end, b"list").startswith(b"Unrecognized command")
+
+
+def test_split_frames():
+    server_end, client_end = socket.socketpair()
+    connection = Connection(server_end)
+    frame = encode_message(b"x" * 100_000)
+    client_end.sendall(frame[:2])
+    connection.receive()
+    assert list(connection.messages()) == []
+    # the header is complete, the buffer grows to fit the message
+    client_end.sendall(frame[2:10])
+    connection.receive()
+    assert list(connection.messages()) == []
+    client_end.sendall(frame[10:])
+    messages: list[bytes] = []
+    while not messages:
+        connection.receive()
+        messages = list(connection.messages())
+    assert messages == [b"x" * 100_000]
+    server_end.close()
+    client_end.close()
+
+
+def test_coalesced_frames():
+    server_end, client_end = socket.socketpair()
+    connection = Connection(server_end)
+    client_end.sendall(encode_message(b"get a") + encode_message(b"get b") + b"\x00")
+    connection.receive()
+    assert list(connection.messages()) == [b"get a", b"get b"]
+    client_end.sendall(b"\x00\x00\x05get c")
+    connection.receive()
+    assert list(connection.messages()) == [b"get c"]
+    server_end.close()
+    client_end.close()
+
+
+def test_oversized_frame_closes_connection(node, connection):
+    server_end, client_end = connection
+    client_end.sendall(HEADER.pack(MAX_MESSAGE_SIZE + 1))
+    node._on_ready(server_end, selectors.EVENT_READ)
+    assert server_end not in node._connections
+    assert client_end.recv(1) == b""